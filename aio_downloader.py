@@ -0,0 +1,450 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: asyncio download transport. The whole queue runs on one event loop
+#  in a single thread and a bounded semaphore caps the transfers in flight.
+#  Requests are plain HTTP/1.1 over asyncio streams with keep-alive
+#  connections per host, so tens of thousands of small segment fetches cost
+#  sockets instead of threads or processes.
+# -----------------------------------------------------------------------------
+#
+### Packages
+import os
+import ssl
+import time
+import asyncio
+from urllib.parse import urlsplit
+# Logging
+import logging
+# Request Headers, Resumable Downloads
+from curl_pool import request_headers, url_hostname, get_stall_limits
+from downloader import part_filename, resume_offset, resume_complete, resume_discard, validator_load, validator_save, reply_validator, content_range_start
+from downloader import hedge_filename, hedge_complete, hedge_discard
+# Transport Interface
+from transport import Transport, transfer_info
+# Rate Limits
+from ratelimit import get_limiter
+
+log = logging.getLogger('Tool')
+
+# Same connect timeout as the curl transfers
+connect_timeout = 10
+read_size = 65536
+
+#-----------------------------------------------------------------------#
+# Functions
+#-----------------------------------------------------------------------#
+
+# Error reply from the server, worded like the curl FAILONERROR message
+class HttpError(Exception):
+
+	def __init__(self, status):
+		Exception.__init__(self, 'The requested URL returned error: ' + str(status))
+		self.status = status
+
+# Transfer aborted by the stall detection, worded like the curl message
+class StallError(TimeoutError):
+
+	def __init__(self, min_speed, window):
+		TimeoutError.__init__(self, 'Operation too slow. Less than ' + str(min_speed) + ' bytes/sec transferred the last ' + str(window) + ' seconds')
+
+# Data arrived after the leases may have run out, nothing more is written
+class LeaseExpired(Exception):
+	pass
+
+# Minimum throughput over a window of 'window' seconds, the same check as
+# curl's LOW_SPEED_LIMIT/LOW_SPEED_TIME. Reads wait at most until the end of
+# the current window; a window with too few bytes raises StallError.
+class StallMonitor:
+
+	def __init__(self, min_speed, window):
+		self.min_speed = min_speed
+		self.window = window
+		self.window_start = time.monotonic()
+		self.window_bytes = 0
+
+	def update(self, size):
+		self.window_bytes += size
+
+	def check(self):
+		if self.window_bytes < self.min_speed * self.window:
+			raise StallError(self.min_speed, self.window)
+		self.window_start = time.monotonic()
+		self.window_bytes = 0
+
+	# Await read(), a function returning a coroutine, within the window
+	async def read(self, read):
+		while True:
+			remaining = self.window_start + self.window - time.monotonic()
+			if remaining <= 0:
+				self.check()
+				continue
+			try:
+				return await asyncio.wait_for(read(), remaining)
+			except asyncio.TimeoutError:
+				self.check()
+
+# Read the status line and headers of a response
+async def read_response_head(reader):
+	line = await reader.readline()
+	if not line:
+		raise ConnectionResetError('Connection closed by server')
+	fields = line.decode('latin-1').split(None, 2)
+	version = fields[0]
+	status = int(fields[1])
+	headers = {}
+	while True:
+		line = await reader.readline()
+		if line in (b'\r\n', b'\n', b''):
+			break
+		name, value = line.decode('latin-1').split(':', 1)
+		headers[name.strip().lower()] = value.strip()
+	return version, status, headers
+
+# Copy the response body to 'write', returns the number of bytes read and
+# whether the connection can be used for another request. With a bandwidth
+# cap in 'limiter' the reading pauses whenever the cap is reached, with a
+# StallMonitor in 'monitor' a stalled body raises StallError.
+async def read_response_body(reader, version, headers, write, limiter=None, monitor=None):
+	async def receive(read, *args):
+		if monitor is None:
+			return await read(*args)
+		return await monitor.read(lambda: read(*args))
+	async def deliver(data):
+		write(data)
+		if monitor is not None:
+			monitor.update(len(data))
+		if limiter is not None:
+			delay = limiter.bytes_delay(len(data))
+			if delay > 0:
+				await asyncio.sleep(delay)
+	size = 0
+	keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+	if headers.get('transfer-encoding', '').lower() == 'chunked':
+		while True:
+			line = await receive(reader.readline)
+			length = int(line.split(b';')[0].strip(), 16)
+			if length == 0:
+				# Trailers end with an empty line
+				while (await receive(reader.readline)) not in (b'\r\n', b'\n', b''):
+					pass
+				break
+			while length > 0:
+				data = await receive(reader.readexactly, min(length, read_size))
+				await deliver(data)
+				size += len(data)
+				length -= len(data)
+			await receive(reader.readexactly, 2)
+	elif 'content-length' in headers:
+		length = int(headers['content-length'])
+		while length > 0:
+			data = await receive(reader.readexactly, min(length, read_size))
+			await deliver(data)
+			size += len(data)
+			length -= len(data)
+	else:
+		# No length given, the body runs until the server closes the connection
+		while True:
+			data = await receive(reader.read, read_size)
+			if not data:
+				break
+			await deliver(data)
+			size += len(data)
+		keep_alive = False
+	return size, keep_alive
+
+#-----------------------------------------------------------------------#
+# Download Engine
+#-----------------------------------------------------------------------#
+
+class AsyncDownloader(Transport):
+
+	name = 'asyncio'
+
+	def __init__(self, concurrency, debug=False, controller=None, retry=None, hedge=None, keeper=None):
+		Transport.__init__(self, concurrency, debug, controller, retry, hedge, keeper)
+		self.idle = {}
+		self.errors = []
+		self.dropped = set()
+		self.transfers = 0
+		self.reused = 0
+		self.ssl_context = ssl.create_default_context()
+
+	def run(self, jobs, on_complete, on_failed):
+		return asyncio.run(self.run_jobs(jobs, on_complete, on_failed))
+
+	async def run_jobs(self, jobs, on_complete, on_failed):
+		semaphore = asyncio.BoundedSemaphore(self.concurrency)
+		pending = set()
+		# Task of each running job, and the jobs whose lease was lost
+		running = {}
+		self.dropped = set()
+		self.errors = []
+		keeper = asyncio.ensure_future(self.keep_leases(jobs, running))
+		try:
+			for job in jobs:
+				await semaphore.acquire()
+				# The concurrency controller may allow fewer transfers than the semaphore
+				while len(pending) >= self.slots():
+					await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+				if job in self.dropped:
+					semaphore.release()
+					continue
+				task = asyncio.ensure_future(self.download(job, on_complete, on_failed))
+				running[job] = task
+				pending.add(task)
+				task.add_done_callback(pending.discard)
+				task.add_done_callback(lambda task, job=job: running.pop(job, None))
+				task.add_done_callback(lambda task: semaphore.release())
+				task.add_done_callback(self.task_done)
+			if pending:
+				await asyncio.wait(pending)
+		finally:
+			keeper.cancel()
+			await asyncio.gather(keeper, return_exceptions=True)
+			self.close_idle()
+		# A callback that raised is a bug in the caller, don't hide it
+		if self.errors:
+			raise self.errors[0]
+		return len(jobs)
+
+	# Once a second, give the keeper a chance to renew its leases and cancel
+	# the jobs of the assets whose lease was lost
+	async def keep_leases(self, jobs, running):
+		while True:
+			await asyncio.sleep(1.0)
+			lost = self.lost_assets()
+			if not lost:
+				continue
+			for job in jobs:
+				if job[0] in lost and job not in self.dropped:
+					self.dropped.add(job)
+					self.drop(job)
+					task = running.get(job)
+					if task is not None:
+						task.cancel()
+
+	# Wrap the write function of a transfer so it raises LeaseExpired once
+	# the leases may have run out
+	def leased_write(self, write):
+		if self.keeper is None:
+			return write
+		def guarded(data):
+			if not self.leased():
+				raise LeaseExpired()
+			return write(data)
+		return guarded
+
+	def task_done(self, task):
+		if not task.cancelled() and task.exception() is not None:
+			self.errors.append(task.exception())
+
+	# Idle keep-alive connection to the host, or a new one
+	async def connect(self, key):
+		idle = self.idle.get(key)
+		if idle:
+			reader, writer = idle.pop()
+			return reader, writer, True
+		scheme, host, port = key
+		if scheme == 'https':
+			conn = asyncio.open_connection(host, port, ssl=self.ssl_context, server_hostname=host)
+		else:
+			conn = asyncio.open_connection(host, port)
+		reader, writer = await asyncio.wait_for(conn, connect_timeout)
+		return reader, writer, False
+
+	def release(self, key, reader, writer, keep_alive):
+		if keep_alive:
+			self.idle.setdefault(key, []).append((reader, writer))
+		else:
+			writer.close()
+
+	def close_idle(self):
+		for key in self.idle:
+			for reader, writer in self.idle[key]:
+				writer.close()
+		self.idle = {}
+
+	# One GET request, the body goes to the asset's partial file, or for a
+	# hedge to its own file from the start. 'replied' is set once the
+	# response head has arrived. Returns the transfer info, raises on failure.
+	async def fetch(self, url, local_filename, hedge=False, replied=None):
+		parts = urlsplit(url)
+		key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+		path = parts.path or '/'
+		if parts.query:
+			path += '?' + parts.query
+		start_time = time.monotonic()
+		min_speed, window = get_stall_limits()
+		retry_stale = True
+		while True:
+			monitor = None
+			if min_speed > 0 and window > 0:
+				monitor = StallMonitor(min_speed, window)
+			offset = 0
+			validator = None
+			if not hedge:
+				offset = resume_offset(local_filename)
+			# Continue only a partial file of a known version (see validator_filename())
+			if offset > 0:
+				validator = validator_load(local_filename)
+				if validator is None:
+					log.info('No version recorded for ' + os.path.basename(local_filename) + '.part, downloading from the start')
+					offset = 0
+			lines = ['GET ' + path + ' HTTP/1.1'] + request_headers(url)
+			if offset > 0:
+				log.info('Resuming ' + os.path.basename(local_filename) + ' from byte ' + str(offset))
+				lines.append('Range:bytes=' + str(offset) + '-')
+				if validator:
+					lines.append('If-Range:' + validator)
+			request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+			reader, writer, reused = await self.connect(key)
+			try:
+				writer.write(request)
+				await writer.drain()
+				if monitor is not None:
+					version, status, headers = await monitor.read(lambda: read_response_head(reader))
+				else:
+					version, status, headers = await read_response_head(reader)
+				ttfb = time.monotonic() - start_time
+			except (ConnectionError, asyncio.IncompleteReadError):
+				writer.close()
+				# The server dropped an idle keep-alive connection, try a fresh one
+				if reused and retry_stale:
+					retry_stale = False
+					continue
+				raise
+			except BaseException:
+				writer.close()
+				raise
+			if replied is not None:
+				replied.set()
+			try:
+				if status == 416 and offset > 0:
+					await read_response_body(reader, version, headers, lambda data: None)
+					log.info('Server refused to resume ' + url + ', downloading from the start')
+					resume_discard(local_filename)
+					self.release(key, reader, writer, False)
+					continue
+				if status >= 300:
+					raise HttpError(status)
+				# A 206 must hold exactly the missing bytes
+				if status == 206 and content_range_start(headers.get('content-range', '')) != offset:
+					await read_response_body(reader, version, headers, lambda data: None)
+					log.info('Server sent another range of ' + url + ', downloading from the start')
+					resume_discard(local_filename)
+					self.release(key, reader, writer, False)
+					continue
+				# A 200 reply to a range request is the whole file, of the
+				# version the server has now
+				if not hedge and status == 200:
+					validator_save(local_filename, reply_validator(headers.get('etag'), headers.get('last-modified')))
+				if hedge:
+					fp = open(hedge_filename(local_filename), 'wb')
+				elif status == 206:
+					fp = open(part_filename(local_filename), 'ab')
+				else:
+					fp = open(part_filename(local_filename), 'wb')
+				try:
+					size, keep_alive = await read_response_body(reader, version, headers, self.leased_write(fp.write), get_limiter(), monitor)
+				finally:
+					fp.close()
+			except BaseException:
+				writer.close()
+				raise
+			peer = writer.get_extra_info('peername')
+			self.release(key, reader, writer, keep_alive)
+			self.transfers += 1
+			if reused:
+				self.reused += 1
+			if hedge:
+				hedge_complete(local_filename)
+			else:
+				resume_complete(local_filename)
+			return transfer_info(
+				total_time=time.monotonic() - start_time,
+				ttfb=ttfb,
+				size=size,
+				http_code=status,
+				primary_ip=peer[0] if peer else None)
+
+	# fetch() with a hedge: when no reply has come within the hedge threshold
+	# the request is sent again on another connection. The first copy to
+	# finish is kept and the other one cancelled.
+	async def fetch_hedged(self, url, local_filename):
+		threshold = None
+		if self.hedge is not None:
+			self.hedge.start()
+			threshold = self.hedge.threshold()
+		replied = asyncio.Event()
+		primary = asyncio.ensure_future(self.fetch(url, local_filename, replied=replied))
+		if threshold is None:
+			return await primary
+		done, pending = await asyncio.wait({primary}, timeout=threshold)
+		if done or replied.is_set() or not self.hedge.allow():
+			return await primary
+		log.info('Hedging slow transfer ' + url + ', no reply after ' + '%0.2f' % threshold + ' seconds')
+		hedge = asyncio.ensure_future(self.fetch(url, local_filename, hedge=True))
+		tasks = {primary, hedge}
+		try:
+			while tasks:
+				done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+				for task in (primary, hedge):
+					if task in done and task.exception() is None:
+						if task is hedge:
+							self.hedge.hedge_won()
+						return task.result()
+			# Both copies failed, report the original one
+			return primary.result()
+		finally:
+			for task in tasks:
+				task.cancel()
+			if tasks:
+				await asyncio.gather(*tasks, return_exceptions=True)
+			hedge_discard(local_filename)
+
+	# Download one job, retrying failures the retry policy allows. The task
+	# keeps its slot while it waits for the next attempt.
+	async def download(self, job, on_complete, on_failed):
+		asset, url, local_filename = job
+		limiter = get_limiter()
+		while True:
+			if limiter is not None:
+				delay = limiter.request_delay(url_hostname(url))
+				if delay > 0:
+					await asyncio.sleep(delay)
+			log.debug('Transfer started: ' + url)
+			try:
+				info = await self.fetch_hedged(url, local_filename)
+				break
+			except LeaseExpired:
+				# Held up past the lease, keep_leases() either renews it and
+				# the partial file is resumed, or cancels this task
+				while not self.leased():
+					await asyncio.sleep(0.1)
+				continue
+			except HttpError as e:
+				error = str(e)
+				self.observe(http_code=e.status)
+				delay = self.failure(job, error, e.status)
+			except ValueError as e:
+				# Malformed URL or reply
+				error = str(e) or e.__class__.__name__
+				self.observe()
+				delay = self.failure(job, error, permanent=True)
+			except (OSError, EOFError, asyncio.TimeoutError) as e:
+				error = str(e) or e.__class__.__name__
+				if isinstance(e, StallError):
+					log.info('Transfer stalled, aborted ' + url)
+					self.stalls += 1
+				self.observe()
+				delay = self.failure(job, error)
+			if delay is None:
+				self.fail(job, error, on_failed)
+				return
+			await asyncio.sleep(delay)
+		self.observe(info)
+		self.complete(job, info, on_complete)
+
+	def summary(self):
+		return [self.transfers, self.reused]
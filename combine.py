@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: Combine downloaded segments into a single stream file (-s).
+#  On copy-on-write filesystems (XFS, btrfs) a segment is cloned into the
+#  output with the FICLONERANGE ioctl: the output shares the segment's disk
+#  extents, no data is written and no extra space is used. Cloning needs
+#  the segment to start on a block boundary of the output, so the gap after
+#  an MPEG-TS segment is filled with TS null packets, which players skip.
+#  Whatever can't be cloned is copied straight into the output file by the
+#  kernel with os.copy_file_range, or os.sendfile where that isn't available. The data never passes through
+#  Python and memory use stays flat no matter how long the archive is.
+#  Falls back to shutil.copyfileobj with a large buffer.
+# -----------------------------------------------------------------------------
+#
+### Packages
+import os
+import math
+import time
+import errno
+import shutil
+import struct
+# Not available on every platform, cloning is skipped without it
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+# Transfer Rate
+from concurrency import rate_msg
+
+# Bytes per kernel copy call, and buffer size of the copyfileobj fallback
+copy_chunk = 1 << 30
+buffer_size = 1 << 20
+
+# Errors that mean the copy method is not supported for these files
+unsupported_errors = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+
+# ioctl(dest_fd, FICLONERANGE, struct file_clone_range) from linux/fs.h,
+# the struct is {s64 src_fd; u64 src_offset; u64 src_length; u64 dest_offset}
+FICLONERANGE = 0x4020940d
+
+# Errors that mean the filesystem can't clone at all
+clone_unsupported_errors = (errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV, errno.ENOTTY, errno.ENOSYS, errno.EBADF, errno.EPERM)
+
+# MPEG-TS packets are 188 bytes and start with the sync byte. A null packet
+# (PID 0x1FFF) carries nothing, demuxers and players drop it.
+ts_packet_size = 188
+ts_sync_byte = b'\x47'
+ts_null_packet = b'\x47\x1f\xff\x10' + b'\xff' * 184
+
+#-----------------------------------------------------------------------#
+# Combiner
+#-----------------------------------------------------------------------#
+
+class Combiner:
+
+	def __init__(self, output_file):
+		self.output_file = output_file
+		self.fp = open(output_file, 'wb')
+		self.files = 0
+		self.bytes = 0
+		# Time spent copying, the segments may arrive over a much longer time
+		self.copy_time = 0
+		self.cloned = 0
+		self.copied = 0
+		self.padded = 0
+		self.clone = fcntl is not None and hasattr(os, 'lseek')
+		self.block_size = os.fstat(self.fp.fileno()).st_blksize or 4096
+		# Best copy method this system supports, downgraded on the first failure
+		if hasattr(os, 'copy_file_range'):
+			self.method = 'copy_file_range'
+		elif hasattr(os, 'sendfile'):
+			self.method = 'sendfile'
+		else:
+			self.method = 'copyfileobj'
+
+	# Append one segment file to the output
+	def append(self, filename):
+		start_time = time.monotonic()
+		with open(filename, 'rb') as src:
+			size = os.fstat(src.fileno()).st_size
+			cloned = 0
+			if self.clone and size > 0:
+				self.align(src.fileno())
+			self.fp.flush()
+			if self.clone and size > 0:
+				cloned = self.clone_range(src.fileno(), size)
+			copied = cloned
+			while copied < size and self.method != 'copyfileobj':
+				try:
+					sent = self.kernel_copy(src.fileno(), copied, min(copy_chunk, size - copied))
+				except OSError as e:
+					if e.errno not in unsupported_errors:
+						raise
+					# Nothing was copied by the failed call, go on with the next method
+					if self.method == 'copy_file_range' and hasattr(os, 'sendfile'):
+						self.method = 'sendfile'
+					else:
+						self.method = 'copyfileobj'
+					continue
+				if sent == 0:
+					break
+				copied += sent
+			if copied < size:
+				src.seek(copied)
+				shutil.copyfileobj(src, self.fp, buffer_size)
+		self.files += 1
+		self.bytes += size
+		self.cloned += cloned
+		self.copied += size - cloned
+		self.copy_time += time.monotonic() - start_time
+		return size
+
+	# Move the end of the output to the next block boundary so the segment can
+	# be cloned whole. The gap is filled with TS null packets, which is only
+	# possible between whole TS packets: the output so far must end on one and
+	# the segment must start with one. Anything else is left unaligned.
+	def align(self, src_fd):
+		if self.bytes % self.block_size == 0 or self.bytes % ts_packet_size:
+			return
+		if self.bytes % math.gcd(ts_packet_size, self.block_size):
+			return
+		if os.pread(src_fd, 1, 0) != ts_sync_byte:
+			return
+		count = 0
+		while (self.bytes + count * ts_packet_size) % self.block_size:
+			count += 1
+		self.fp.write(ts_null_packet * count)
+		self.bytes += count * ts_packet_size
+		self.padded += count * ts_packet_size
+
+	# Share the segment's extents with the output instead of copying the data.
+	# The output must end on a block boundary. The range has to be block
+	# aligned too unless it runs to the end of the segment, so the whole
+	# segment is tried first, then its aligned part. Returns the bytes cloned.
+	def clone_range(self, src_fd, size):
+		if self.bytes % self.block_size:
+			return 0
+		dst_fd = self.fp.fileno()
+		# A length of 0 would clone up to the end of the segment, never pass it
+		for length in (size, size - size % self.block_size):
+			if length == 0:
+				continue
+			try:
+				fcntl.ioctl(dst_fd, FICLONERANGE, struct.pack('qQQQ', src_fd, 0, length, self.bytes))
+			except OSError as e:
+				if e.errno in clone_unsupported_errors:
+					self.clone = False
+					return 0
+				if e.errno == errno.EINVAL:
+					continue
+				raise
+			# Cloning doesn't move the file position, the next write goes after the clone
+			os.lseek(dst_fd, self.bytes + length, os.SEEK_SET)
+			return length
+		return 0
+
+	# Copy 'count' bytes from 'offset' in the segment to the end of the
+	# output, returns the number of bytes copied
+	def kernel_copy(self, src_fd, offset, count):
+		if self.method == 'copy_file_range':
+			return os.copy_file_range(src_fd, self.fp.fileno(), count, offset)
+		return os.sendfile(self.fp.fileno(), src_fd, offset, count)
+
+	def close(self):
+		self.fp.close()
+
+	def summary(self):
+		msg = 'Combined ' + str(self.files) + ' files, ' + str(self.bytes) + ' bytes in ' + '%0.3f' % self.copy_time + ' sec'
+		if self.copy_time > 0:
+			msg += ' (' + rate_msg(self.bytes / self.copy_time) + ', ' + self.method + ')'
+		msg += ', cloned ' + str(self.cloned) + ' bytes, copied ' + str(self.copied) + ' bytes'
+		if self.padded > 0:
+			msg += ', ' + str(self.padded) + ' bytes of TS null packets between segments'
+		return msg
+
+#-----------------------------------------------------------------------#
+# In-order Combine
+#-----------------------------------------------------------------------#
+
+# Combines segments while they are still being downloaded. 'filenames' lists
+# every segment in stream order; complete(index) reports a segment that is
+# on disk, and every segment from the front of the stream that is complete
+# is appended right away. Segments that finish out of order wait until all
+# earlier ones are there, so the output is always a playable prefix.
+class OrderedCombiner:
+
+	def __init__(self, output_file, filenames):
+		self.combiner = Combiner(output_file)
+		self.filenames = filenames
+		self.ready = set()
+		self.next = 0
+
+	def complete(self, index):
+		self.ready.add(index)
+		while self.next in self.ready:
+			self.ready.discard(self.next)
+			self.combiner.append(self.filenames[self.next])
+			self.next += 1
+
+	# Whether every segment has been appended
+	def finished(self):
+		return self.next == len(self.filenames)
+
+	# First segment still missing from the output, None when finished
+	def missing(self):
+		if self.finished():
+			return None
+		return self.filenames[self.next]
+
+	def close(self):
+		self.combiner.close()
+
+	def summary(self):
+		return self.combiner.summary() + ', ' + str(self.next) + '/' + str(len(self.filenames)) + ' segments in order'
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: Adaptive concurrency for segment downloads (AIMD).
+#  Every finished transfer is reported to the controller. Once per window
+#  it compares the aggregate throughput with the previous window: while
+#  throughput keeps improving it allows one more transfer in flight
+#  (additive increase), on errors or 429/503 replies it halves the number
+#  of transfers (multiplicative decrease). Rising time-to-first-byte
+#  means the CDN is queueing requests, so no increase is made then.
+# -----------------------------------------------------------------------------
+#
+### Packages
+import re
+import time
+# Logging
+import logging
+
+log = logging.getLogger('Tool')
+
+#-----------------------------------------------------------------------#
+# Functions
+#-----------------------------------------------------------------------#
+
+# HTTP replies that mean the server wants fewer requests
+throttle_codes = (429, 503)
+
+# HTTP status code in a curl style error message, 0 if there is none
+def error_http_code(error):
+	m = re.search(r'returned error: (\d+)', str(error))
+	if m:
+		return int(m.group(1))
+	return 0
+
+#-----------------------------------------------------------------------#
+# AIMD Controller
+#-----------------------------------------------------------------------#
+
+class AimdController:
+
+	def __init__(self, initial, minimum=1, maximum=64, interval=2.0, increase=1, decrease=0.5, error_rate=0.1):
+		self.minimum = max(1, int(minimum))
+		self.maximum = max(self.minimum, int(maximum))
+		self.limit = min(max(int(initial), self.minimum), self.maximum)
+		self.interval = interval
+		self.increase = increase
+		self.decrease = decrease
+		self.error_rate = error_rate
+		self.start_time = time.monotonic()
+		self.last_cut = 0
+		self.last_rate = None
+		self.ttfb_baseline = None
+		self.history = [(0, self.limit, 'start')]
+		self.reset_window()
+
+	def reset_window(self):
+		self.window_start = time.monotonic()
+		self.window_bytes = 0
+		self.window_count = 0
+		self.window_errors = 0
+		self.window_ttfb = 0
+		self.window_ttfb_count = 0
+
+	def set_limit(self, limit, reason):
+		limit = min(max(int(limit), self.minimum), self.maximum)
+		if limit == self.limit:
+			return
+		log.info('Concurrency ' + str(self.limit) + ' -> ' + str(limit) + ' (' + reason + ')')
+		self.limit = limit
+		self.history.append((time.monotonic() - self.start_time, limit, reason))
+
+	# Report one finished transfer. 'size' is the bytes received, 'ttfb' the
+	# time to first byte in seconds, 'failed' is True for a failed transfer.
+	def record(self, size=0, ttfb=None, http_code=None, failed=False):
+		now = time.monotonic()
+		self.window_count += 1
+		self.window_bytes += size or 0
+		if failed:
+			self.window_errors += 1
+		if ttfb:
+			self.window_ttfb += ttfb
+			self.window_ttfb_count += 1
+		# Throttling replies cut right away, but only once per window so a
+		# burst of 503s doesn't collapse the level to the minimum
+		if http_code in throttle_codes:
+			if now - self.last_cut >= self.interval:
+				self.last_cut = now
+				self.last_rate = None
+				self.set_limit(self.limit * self.decrease, 'HTTP ' + str(http_code))
+				self.reset_window()
+			return
+		if now - self.window_start >= self.interval:
+			self.update(now)
+
+	# End of a window, decide on the next level
+	def update(self, now):
+		rate = self.window_bytes / (now - self.window_start)
+		errors = self.window_errors / self.window_count
+		ttfb = None
+		if self.window_ttfb_count:
+			ttfb = self.window_ttfb / self.window_ttfb_count
+			if self.ttfb_baseline is None or ttfb < self.ttfb_baseline:
+				self.ttfb_baseline = ttfb
+		if errors > self.error_rate:
+			self.last_cut = now
+			self.last_rate = None
+			self.set_limit(self.limit * self.decrease, 'error rate ' + str(int(errors * 100)) + '%')
+		elif self.last_rate is None or rate > self.last_rate * 1.05:
+			if ttfb is None or ttfb <= 2 * self.ttfb_baseline:
+				self.set_limit(self.limit + self.increase, 'throughput ' + rate_msg(rate))
+			self.last_rate = rate
+		else:
+			self.last_rate = rate
+		self.reset_window()
+
+	# Level changes for the run log, as 'level@seconds' from the start
+	def summary(self):
+		steps = []
+		for elapsed, limit, reason in self.history:
+			steps.append(str(limit) + '@' + str(int(elapsed)) + 's')
+		return 'Concurrency = ' + str(self.limit) + ' (history: ' + ', '.join(steps) + ')'
+
+# Human readable transfer rate
+def rate_msg(rate):
+	if rate >= 1048576:
+		return '%0.1f MB/s' % (rate / 1048576)
+	return '%0.1f KB/s' % (rate / 1024)
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# sudo apt install python3-pycurl
+# Purpose: Pool of pre-configured pycurl handles keyed by hostname.
+#  A handle keeps its connection open after a transfer, so handing the
+#  same handle back out for the same host skips the TCP+TLS handshake.
+#  Every download path (stream.py, stream-m.py, rumble.py, gpt.py) takes
+#  its handles from here. One pool per process.
+# -----------------------------------------------------------------------------
+#
+### Packages
+# Third-Party
+import pycurl
+
+#-----------------------------------------------------------------------#
+# Functions
+#-----------------------------------------------------------------------#
+
+# Hostname part of an asset url
+def url_hostname(url):
+	return url.split('/')[2]
+
+# Request headers sent with every asset download
+def request_headers(url):
+	hostname = url_hostname(url)
+	headers = [
+		'Accept:application/octet-stream',
+		'Connection:keep-alive',
+		'Content-Type:application/gzip',
+		'Host:'+hostname,
+		'User-Agent:Python'
+	]
+	return headers
+
+# Stall detection: a transfer that moves fewer than 'stall_speed' bytes/sec
+# for 'stall_time' seconds is aborted (0 = off). A slow but steady download
+# of a long asset keeps going, a whole-transfer timeout would cut it off.
+stall_speed = 0
+stall_time = 0
+
+def set_stall_limits(min_speed, window):
+	global stall_speed, stall_time
+	stall_speed = max(0, int(min_speed))
+	stall_time = max(0, int(window))
+
+def get_stall_limits():
+	return [stall_speed, stall_time]
+
+# Whether a curl error is an abort by the stall detection
+def stalled(errno, errmsg):
+	return errno == pycurl.E_OPERATION_TIMEDOUT and 'too slow' in str(errmsg)
+
+# Apply the options shared by every transfer to a curl handle
+def curl_setup(c, debug=False):
+	# these keepalive options are not available on CentOS.
+	# these options are kept here for reference.
+	#c.setopt(c.TCP_KEEPALIVE, True)
+	#c.setopt(c.TCP_KEEPINTVL, 30L)
+	#c.setopt(c.TCP_KEEPIDLE, 120L)
+	c.setopt(c.FOLLOWLOCATION, False)
+	c.setopt(c.CONNECTTIMEOUT, 10)
+	# The connection is dropped if the asset isn't downloaded within the c.TIMEOUT window.
+	#c.setopt(c.TIMEOUT, 60L)  # DO NOT set this timeout!
+	# Stalled transfers are dropped instead (see set_stall_limits)
+	if stall_speed > 0 and stall_time > 0:
+		c.setopt(c.LOW_SPEED_LIMIT, stall_speed)
+		c.setopt(c.LOW_SPEED_TIME, stall_time)
+	c.setopt(c.NOSIGNAL, True)
+	#c.setopt(c.FORBID_REUSE, True)  # Disabled, it will reuse same TCP socket
+	c.setopt(c.FAILONERROR, True)
+	# The built-in progress meter writes to stderr, which is unreadable
+	# with many transfers running at once.
+	c.setopt(c.NOPROGRESS, True)
+	if debug == True:
+		c.setopt(c.VERBOSE, True)
+	return c
+
+#-----------------------------------------------------------------------#
+# Handle Pool
+#-----------------------------------------------------------------------#
+
+class CurlPool:
+
+	def __init__(self, debug=False):
+		self.debug = debug
+		self.idle = {}
+		self.transfers = 0
+		self.reused = 0
+		# DNS cache, TLS sessions and open connections are shared by all
+		# handles in the pool. The connection cache share is missing on
+		# older libcurl builds, so only share what is available.
+		self.share = pycurl.CurlShare()
+		for lock in ('LOCK_DATA_DNS', 'LOCK_DATA_SSL_SESSION', 'LOCK_DATA_CONNECT'):
+			if hasattr(pycurl, lock):
+				try:
+					self.share.setopt(pycurl.SH_SHARE, getattr(pycurl, lock))
+				except pycurl.error:
+					pass
+
+	# Take a handle configured for the url's host, creating one if none are idle
+	def get(self, url):
+		hostname = url_hostname(url)
+		idle = self.idle.get(hostname)
+		if idle:
+			c = idle.pop()
+		else:
+			c = curl_setup(pycurl.Curl(), self.debug)
+			c.setopt(c.SHARE, self.share)
+			c.headers = request_headers(url)
+			c.setopt(c.HTTPHEADER, c.headers)
+			c.hostname = hostname
+		c.fp = None
+		c.setopt(c.URL, url)
+		return c
+
+	# Count a finished transfer; libcurl reports zero new connects when it
+	# ran over a connection that was already open
+	def record(self, c):
+		self.transfers += 1
+		try:
+			if c.getinfo(c.NUM_CONNECTS) == 0:
+				self.reused += 1
+		except pycurl.error:
+			pass
+
+	# Hand a handle back to the pool once its transfer is done
+	def put(self, c):
+		c.fp = None
+		# Per-transfer options must not carry over to the next transfer
+		c.setopt(c.RESUME_FROM_LARGE, 0)
+		c.unsetopt(c.RANGE)
+		c.setopt(c.HTTPHEADER, c.headers)
+		c.unsetopt(c.HEADERFUNCTION)
+		self.idle.setdefault(c.hostname, []).append(c)
+
+	def summary(self):
+		return [self.transfers, self.reused]
+
+	def close(self):
+		for hostname in self.idle:
+			for c in self.idle[hostname]:
+				c.close()
+		self.idle = {}
+		self.share.close()
+
+#-----------------------------------------------------------------------#
+# Process-wide pool
+#-----------------------------------------------------------------------#
+
+pool = None
+
+# The pool shared by every download path in this process. Worker processes
+# of a ProcessPoolExecutor each build their own on first use.
+def get_pool(debug=False):
+	global pool
+	if pool is None:
+		pool = CurlPool(debug)
+	return pool
+
+# A worker process forked from a parent that already had a pool must not
+# use the parent's handles and connections
+def forget_pool():
+	global pool
+	pool = None
+
+# Close the process-wide pool, if one was ever created
+def close_pool():
+	global pool
+	if pool is not None:
+		pool.close()
+		pool = None
+
+# Log line for the run summary
+def reuse_summary(stats):
+	transfers, reused = stats
+	return 'Connections Reused = ' + str(reused) + '/' + str(transfers) + ' transfers'
+
+def stall_summary(stalls):
+	return 'Stall Aborts = ' + str(stalls)
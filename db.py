@@ -0,0 +1,389 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: Data access for the tool database, shared by all the scripts.
+#  Every process keeps one SQLite connection open for all its queries
+#  instead of connecting per call, so SQLite's prepared statement cache is
+#  reused across the thousands of status updates of a run. The database
+#  uses the WAL journal (readers never block the writer) and a busy
+#  timeout, so worker processes and the main process wait their turn
+#  instead of failing with "database is locked".
+# -----------------------------------------------------------------------------
+#
+### Packages
+import os
+import re
+import time
+import sqlite3
+
+# Milliseconds a query waits for another process to finish writing
+busy_timeout = 30000
+
+# Prepared statements kept per connection
+cached_statements = 256
+
+# One connection per database, with the pid of the process that opened it
+connections = {}
+
+# Ingest Status, every script reads and writes these:
+# 0 New
+# 1 Queued
+# 2 Active     claimed by a stream.py process, see db_claim()
+# 3 Completed
+# 5 Failed
+# 4 is no longer used, rumble.py/gpt.py wrote it for failed downloads
+status_new = 0
+status_queued = 1
+status_active = 2
+status_completed = 3
+status_failed = 5
+
+# Version of the database layout, kept in PRAGMA user_version
+schema_version = 3
+
+# Job of the assets imported without -j, it owns the database's assets from
+# before jobs existed
+default_job = 'default'
+
+#-----------------------------------------------------------------------#
+# Connection
+#-----------------------------------------------------------------------#
+
+# The connection of this process to the database, opened on first use
+def get_db(database):
+	pid = os.getpid()
+	entry = connections.get(database)
+	if entry is not None and entry[0] == pid:
+		return entry[1]
+	# A forked worker process must not use its parent's connection
+	conn = sqlite3.connect(database, timeout=busy_timeout / 1000, cached_statements=cached_statements)
+	conn.execute("PRAGMA journal_mode=WAL")
+	conn.execute("PRAGMA synchronous=NORMAL")
+	conn.execute("PRAGMA busy_timeout=" + str(busy_timeout))
+	conn.execute("PRAGMA foreign_keys=ON")
+	connections[database] = (pid, conn)
+	return conn
+
+def close_db():
+	pid = os.getpid()
+	for database, entry in list(connections.items()):
+		if entry[0] == pid:
+			entry[1].close()
+		del connections[database]
+
+#-----------------------------------------------------------------------#
+# Schema
+#-----------------------------------------------------------------------#
+
+sql_jobs = """ CREATE TABLE IF NOT EXISTS "jobs" (
+	id INTEGER NOT NULL PRIMARY KEY,
+	name TEXT NOT NULL UNIQUE,
+	created TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+); """
+
+sql_assets = """ CREATE TABLE "assets" (
+	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	asset TEXT NOT NULL DEFAULT "",
+	asset_uri TEXT NOT NULL DEFAULT "",
+	status INTEGER NOT NULL DEFAULT 0,
+	attempts INTEGER NOT NULL DEFAULT 0,
+	last_error TEXT NOT NULL DEFAULT "",
+	sequence INTEGER NOT NULL DEFAULT 0,
+	media_sequence INTEGER NOT NULL DEFAULT 0,
+	job INTEGER NOT NULL DEFAULT 0 REFERENCES jobs (id),
+	owner TEXT NOT NULL DEFAULT "",
+	lease_expires REAL NOT NULL DEFAULT 0,
+	duration REAL NOT NULL DEFAULT 0
+); """
+
+# One row per completed download with the transfer details from curl
+# getinfo (see transfer_info() in transport.py), times in seconds from the
+# start of the transfer. primary_ip is the CDN edge that served it.
+sql_metrics = """ CREATE TABLE IF NOT EXISTS "metrics" (
+	id INTEGER NOT NULL PRIMARY KEY,
+	asset_id INTEGER NOT NULL REFERENCES assets (id) ON DELETE CASCADE,
+	recorded REAL NOT NULL,
+	namelookup_time REAL,
+	connect_time REAL,
+	appconnect_time REAL,
+	starttransfer_time REAL,
+	total_time REAL,
+	size INTEGER,
+	speed REAL,
+	http_code INTEGER,
+	primary_ip TEXT
+); """
+
+# create the database if not present
+def db_check_exists(database):
+	exists = os.path.isfile(database)
+	if exists:
+		#print('Database ' + database + ' already created.')
+		db_upgrade(database)
+		return True
+	else:
+		print();print('Database ' + database + ' missing, creating new database.')
+		conn = get_db(database)
+		conn.execute(sql_assets)
+		conn.commit()
+		db_upgrade(database)
+		print();print('Database ' + database + ' created.')
+		return True
+
+# Add the columns and indexes to a database created before they existed,
+# then bring the data up to schema_version
+def db_upgrade(database):
+	conn = get_db(database)
+	c = conn.cursor()
+	c.execute("PRAGMA table_info(assets)")
+	columns = [column[1] for column in c.fetchall()]
+	if 'attempts' not in columns:
+		c.execute("ALTER TABLE assets ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+	if 'last_error' not in columns:
+		c.execute('ALTER TABLE assets ADD COLUMN last_error TEXT NOT NULL DEFAULT ""')
+	if 'sequence' not in columns:
+		c.execute("ALTER TABLE assets ADD COLUMN sequence INTEGER NOT NULL DEFAULT 0")
+		c.execute("ALTER TABLE assets ADD COLUMN media_sequence INTEGER NOT NULL DEFAULT 0")
+		# Assets were imported in playlist order
+		c.execute("UPDATE assets SET sequence=id")
+	if 'job' not in columns:
+		c.execute("ALTER TABLE assets ADD COLUMN job INTEGER NOT NULL DEFAULT 0")
+	if 'owner' not in columns:
+		c.execute('ALTER TABLE assets ADD COLUMN owner TEXT NOT NULL DEFAULT ""')
+		c.execute("ALTER TABLE assets ADD COLUMN lease_expires REAL NOT NULL DEFAULT 0")
+	if 'duration' not in columns:
+		# Seconds of media in the segment, the #EXTINF of the playlist
+		c.execute("ALTER TABLE assets ADD COLUMN duration REAL NOT NULL DEFAULT 0")
+	c.execute("PRAGMA user_version")
+	version = c.fetchone()[0]
+	if version < 2:
+		c.execute(sql_jobs)
+		c.execute("INSERT OR IGNORE INTO jobs (id,name) VALUES (0,?)", (default_job,))
+		c.execute("INSERT OR IGNORE INTO jobs (id,name) SELECT DISTINCT job, 'job' || job FROM assets")
+		c.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='assets'")
+		if 'REFERENCES' not in c.fetchone()[0]:
+			# SQLite only adds a foreign key by rebuilding the table, its
+			# indexes are created again below
+			c.execute(sql_assets.replace('"assets"', '"assets_new"', 1))
+			c.execute("INSERT INTO assets_new (id, asset, asset_uri, status, attempts, last_error, sequence, media_sequence, job, owner, lease_expires, duration) SELECT id, asset, asset_uri, status, attempts, last_error, sequence, media_sequence, job, owner, lease_expires, duration FROM assets")
+			c.execute("DROP TABLE assets")
+			c.execute("ALTER TABLE assets_new RENAME TO assets")
+		# Every lookup is by job now
+		c.execute("DROP INDEX IF EXISTS assets_status_sequence")
+		c.execute("DROP INDEX IF EXISTS assets_asset")
+	if version < 1:
+		# rumble.py/gpt.py wrote 3 for completed and 4 for failed but looked
+		# for 7 and 6, their completed assets were downloaded again every run
+		c.execute("UPDATE assets SET status=? WHERE status IN (4,6)", (status_failed,))
+		c.execute("UPDATE assets SET status=? WHERE status=7", (status_completed,))
+	# Status lookups and counts of a job, and its completed assets in
+	# playlist order, are read straight off this index
+	c.execute("CREATE INDEX IF NOT EXISTS assets_job_status ON assets (job, status, sequence)")
+	# An asset is only imported once per job
+	c.execute("SELECT name FROM sqlite_master WHERE type='index' AND name='assets_job_uri'")
+	if c.fetchone() is None:
+		# Of an asset imported more than once before this index existed keep
+		# the copy that got furthest (completed, active, queued, failed, new),
+		# its file and metrics go with it, then the first imported
+		c.execute("DELETE FROM assets WHERE id IN (SELECT id FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY job, asset_uri ORDER BY CASE status WHEN ? THEN 0 WHEN ? THEN 1 WHEN ? THEN 2 WHEN ? THEN 3 ELSE 4 END, id) AS copy FROM assets) WHERE copy > 1)", (status_completed, status_active, status_queued, status_failed))
+		c.execute("CREATE UNIQUE INDEX assets_job_uri ON assets (job, asset_uri)")
+	# The download workers send their state changes by asset id now, the
+	# file name index of earlier versions is not used
+	c.execute("DROP INDEX IF EXISTS assets_job_asset")
+	if version < 3:
+		c.execute(sql_metrics)
+		c.execute("CREATE INDEX IF NOT EXISTS metrics_asset ON metrics (asset_id)")
+	if version < schema_version:
+		c.execute("PRAGMA user_version=" + str(schema_version))
+	conn.commit()
+
+# Remove the assets of a job, or of every job when 'job' is None
+def db_purge(database, job=None):
+	conn = get_db(database)
+	if job is None:
+		conn.execute("DROP TABLE assets")
+		conn.execute(sql_assets)
+		conn.execute("DELETE FROM jobs WHERE id<>0")
+		conn.commit()
+		db_upgrade(database)
+		print();print('Database ' + database + ' purged.');print()
+	else:
+		conn.execute("DELETE FROM assets WHERE job=?", (job,))
+		conn.commit()
+		print();print('Job ' + str(job) + ' purged from database ' + database + '.');print()
+
+#-----------------------------------------------------------------------#
+# Jobs
+#-----------------------------------------------------------------------#
+
+# Id of the job called 'name', the job is created when it doesn't exist.
+# Job names are folder names, raises ValueError for anything else.
+def db_get_job(database, name):
+	if not re.fullmatch(r'[A-Za-z0-9_][A-Za-z0-9_.-]*', name):
+		raise ValueError('Invalid job name ' + repr(name) + ', use letters, digits, _ . and -')
+	conn = get_db(database)
+	conn.execute("INSERT OR IGNORE INTO jobs (name) VALUES (?)", (name,))
+	conn.commit()
+	c = conn.execute("SELECT id FROM jobs WHERE name=?", (name,))
+	return c.fetchone()[0]
+
+# Every job as (id, name, created, assets)
+def db_list_jobs(database):
+	c = get_db(database).cursor()
+	c.execute("SELECT jobs.id, jobs.name, jobs.created, COUNT(assets.id) FROM jobs LEFT JOIN assets ON assets.job=jobs.id GROUP BY jobs.id ORDER BY jobs.id")
+	return c.fetchall()
+
+# Folder of a job's downloads, the default job keeps storage_path itself
+def job_storage_path(storage_path, name):
+	if name == default_job:
+		return storage_path
+	return os.path.join(storage_path, name, '')
+
+# SQL placeholders for a list of values, '(?,?,?)'
+def sql_list(values):
+	return '(' + ','.join('?' * len(values)) + ')'
+
+#-----------------------------------------------------------------------#
+# Queries
+#-----------------------------------------------------------------------#
+
+# Number of assets of the 'jobs' in each status as {status: count}, one pass
+# over the job/status index instead of loading the rows
+def db_status_counts(database, jobs):
+	c = get_db(database).cursor()
+	c.execute("SELECT status, COUNT(*) FROM assets WHERE job IN " + sql_list(jobs) + " GROUP BY status", list(jobs))
+	return dict(c.fetchall())
+
+# Assets of a job with the given status, in playlist order. Use db_iter_status
+# to go through them without a list, db_get_status when they are updated on the way.
+def db_get_status(database, status, job):
+	return db_iter_status(database, status, job).fetchall()
+
+# Lazy cursor over the assets of a job with the given status, read off the
+# (job, status, sequence) index one row at a time
+def db_iter_status(database, status, job):
+	c = get_db(database).cursor()
+	c.execute("SELECT * FROM assets WHERE job=? AND status=? ORDER BY sequence", (job, status))
+	return c
+
+# Every asset of a job in playlist order
+def db_get_assets(database, job):
+	c = get_db(database).cursor()
+	c.execute("SELECT * FROM assets WHERE job=? ORDER BY sequence", (job,))
+	return c.fetchall()
+
+# Runs of playlist positions with no completed asset, as (first, last) pairs.
+# A stream file combined now would skip these.
+def db_sequence_gaps(database, status, job):
+	c = get_db(database).cursor()
+	c.execute("SELECT MIN(sequence), MAX(sequence) FROM assets WHERE job=?", (job,))
+	first, last = c.fetchone()
+	if first is None:
+		return []
+	# One position past the end closes a gap at the end of the playlist
+	c.execute("""SELECT prev+1, sequence-1 FROM (
+		SELECT sequence, LAG(sequence,1,?) OVER (ORDER BY sequence) AS prev FROM (
+			SELECT sequence FROM assets WHERE job=? AND status=? UNION ALL SELECT ?))
+		WHERE sequence > prev+1 ORDER BY sequence""", (first-1, job, status, last+1))
+	return c.fetchall()
+
+# Sequence gaps as text, e.g. '12, 40-45'
+def gaps_msg(gaps):
+	return ', '.join([str(a) if a == b else str(a) + '-' + str(b) for a, b in gaps])
+
+#-----------------------------------------------------------------------#
+# Updates
+#-----------------------------------------------------------------------#
+
+def delete_asset_db(database,aid):
+	conn = get_db(database)
+	conn.execute("DELETE FROM assets WHERE id=?", (int(aid),))
+	conn.commit()
+
+# Move every asset of the 'jobs' in one of 'statuses' to 'status' with one
+# UPDATE, returns the number of assets moved
+def db_move_status(database,statuses,status,jobs):
+	conn = get_db(database)
+	c = conn.execute("UPDATE assets SET status=? WHERE job IN " + sql_list(jobs) + " AND status IN " + sql_list(statuses), [status] + list(jobs) + list(statuses))
+	conn.commit()
+	return c.rowcount
+
+# Write a batch of state changes in one transaction, each one is
+# (status, attempts to add, last error or None, asset id). The asset's lease
+# ends with it. 'metrics' are the transfer details of the downloads among
+# them, metric_values() followed by the asset id.
+def db_apply_transitions(database,transitions,metrics=()):
+	conn = get_db(database)
+	conn.executemany("UPDATE assets SET status=?, attempts=attempts+?, last_error=COALESCE(?,last_error), owner='', lease_expires=0 WHERE id=?", transitions)
+	conn.executemany("INSERT INTO metrics (" + metric_columns + ",asset_id) VALUES (?,?,?,?,?,?,?,?,?,?,?)", metrics)
+	conn.commit()
+
+def db_update_asset_status(database,aid,status):
+	conn = get_db(database)
+	conn.execute("UPDATE assets SET status=? WHERE id=?", (status,aid))
+	conn.commit()
+
+#-----------------------------------------------------------------------#
+# Leases
+#-----------------------------------------------------------------------#
+
+# Claim up to 'count' queued assets of the 'jobs' for 'owner', in playlist
+# order (job by job). They move
+# to 'active' with a lease of 'lease' seconds; no other process claims them
+# until the lease runs out. Active assets whose lease ran out, because their
+# process crashed or was killed, go back to the queue first.
+# Returns the claimed assets.
+def db_claim(database,owner,count,lease,queued,active,jobs):
+	conn = get_db(database)
+	now = time.time()
+	expires = now + lease
+	in_jobs = "job IN " + sql_list(jobs)
+	# Each UPDATE takes the write lock and selects its rows under it, two
+	# processes never claim the same asset
+	conn.execute("UPDATE assets SET status=?, owner='', lease_expires=0 WHERE " + in_jobs + " AND status=? AND lease_expires<?", [queued] + list(jobs) + [active,now])
+	conn.execute("UPDATE assets SET status=?, owner=?, lease_expires=? WHERE id IN (SELECT id FROM assets WHERE " + in_jobs + " AND status=? ORDER BY job, sequence LIMIT ?)", [active,owner,expires] + list(jobs) + [queued,count])
+	# Still in the same transaction, the lease time tells this claim apart
+	c = conn.execute("SELECT * FROM assets WHERE " + in_jobs + " AND status=? AND owner=? AND lease_expires=? ORDER BY job, sequence", list(jobs) + [active,owner,expires])
+	assets = c.fetchall()
+	conn.commit()
+	return assets
+
+# Extend the lease of every asset of the 'jobs' 'owner' still has active.
+# Returns the ids of those assets, an asset missing from them was claimed by
+# another process after its lease ran out.
+def db_renew_leases(database,owner,lease,active,jobs):
+	conn = get_db(database)
+	conn.execute("UPDATE assets SET lease_expires=? WHERE job IN " + sql_list(jobs) + " AND status=? AND owner=?", [time.time() + lease] + list(jobs) + [active,owner])
+	c = conn.execute("SELECT id FROM assets WHERE job IN " + sql_list(jobs) + " AND status=? AND owner=?", list(jobs) + [active,owner])
+	held = set([row[0] for row in c.fetchall()])
+	conn.commit()
+	return held
+
+# Put the assets of the 'jobs' 'owner' still has active back in the queue
+def db_release(database,owner,queued,active,jobs):
+	conn = get_db(database)
+	c = conn.execute("UPDATE assets SET status=?, owner='', lease_expires=0 WHERE job IN " + sql_list(jobs) + " AND status=? AND owner=?", [queued] + list(jobs) + [active,owner])
+	conn.commit()
+	return c.rowcount
+
+#-----------------------------------------------------------------------#
+# Transfer Metrics
+#-----------------------------------------------------------------------#
+
+metric_columns = "recorded,namelookup_time,connect_time,appconnect_time,starttransfer_time,total_time,size,speed,http_code,primary_ip"
+
+# Values of a metrics row, in metric_columns order, from the transfer_info()
+# dict of a completed download
+def metric_values(info):
+	return (time.time(), info['namelookup_time'], info['connect_time'], info['appconnect_time'], info['ttfb'], info['total_time'], info['size'], info['speed'], info['http_code'], info['primary_ip'])
+
+# Transfers of a job per CDN edge, slowest first, as (primary_ip, transfers,
+# average DNS lookup, connect, first byte and total time, average speed,
+# bytes). Only the last download of each asset counts.
+def db_edge_metrics(database, job):
+	c = get_db(database).cursor()
+	c.execute("""SELECT primary_ip, COUNT(*), AVG(namelookup_time), AVG(connect_time), AVG(starttransfer_time), AVG(total_time), AVG(speed), SUM(size)
+		FROM metrics JOIN assets ON assets.id=metrics.asset_id
+		WHERE assets.job=? AND metrics.id IN (SELECT MAX(id) FROM metrics GROUP BY asset_id)
+		GROUP BY primary_ip ORDER BY AVG(speed)""", (job,))
+	return c.fetchall()
@@ -0,0 +1,943 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# sudo apt install python3-pycurl
+# Purpose: pycurl download engines. MultiDownloader keeps up to N transfers
+#  in flight in a single process on pycurl.CurlMulti, ProcessDownloader runs
+#  blocking transfers in a multiprocessing pool. Both report each asset back
+#  to the caller as soon as its transfer finishes (see transport.py).
+# -----------------------------------------------------------------------------
+#
+### Packages
+import os
+import re
+import time
+import heapq
+from collections import deque
+import multiprocessing
+# Logging
+import logging
+# Third-Party
+import pycurl
+# Curl Handle Pool
+from curl_pool import get_pool, forget_pool, url_hostname, stalled
+# Rate Limits
+from ratelimit import get_limiter, set_limiter, wait_request, throttled_writer, paced_writer
+# Transport Interface
+from transport import Transport, transfer_info
+# HTTP Status of Errors
+from concurrency import error_http_code
+
+log = logging.getLogger('Tool')
+
+# Seconds between checks for transfers to hedge
+hedge_interval = 0.1
+
+#-----------------------------------------------------------------------#
+# Functions
+#-----------------------------------------------------------------------#
+
+# Assets are written to '<file>.part' while the transfer is running and
+# renamed once it completes, so a file under its real name is always whole
+# and a '.part' file is a partial download that can be resumed.
+def part_filename(local_filename):
+	return local_filename + '.part'
+
+# Number of bytes already written for a partial download
+def resume_offset(local_filename):
+	part = part_filename(local_filename)
+	if os.path.isfile(part):
+		return os.path.getsize(part)
+	return 0
+
+# A partial file is only continued while the asset on the server is still
+# the one it holds the start of. The version of the asset is recorded next
+# to the partial file, '<file>.validator': the strong ETag or Last-Modified
+# of the reply that started it, empty if the server sent neither. A resumed
+# request sends it in If-Range, a server whose asset changed since replies
+# with the whole new asset. A partial file without this record is of
+# unknown origin and is downloaded again from the start.
+def validator_filename(local_filename):
+	return local_filename + '.validator'
+
+# The recorded version of the partial file, None if there is no record
+def validator_load(local_filename):
+	try:
+		with open(validator_filename(local_filename)) as f:
+			return f.read().strip()
+	except OSError:
+		return None
+
+def validator_save(local_filename, validator):
+	with open(validator_filename(local_filename), 'w') as f:
+		f.write(validator + '\n')
+
+def validator_discard(local_filename):
+	validator = validator_filename(local_filename)
+	if os.path.isfile(validator):
+		os.remove(validator)
+
+# Version of the asset from the ETag and Last-Modified headers of a reply,
+# for If-Range. A weak ETag can't be used there, '' when there is neither.
+def reply_validator(etag, last_modified):
+	if etag and not etag.startswith('W/'):
+		return etag
+	return last_modified or ''
+
+# Start of the body in a Content-Range header, None if it isn't one
+def content_range_start(value):
+	m = re.match(r'\s*bytes\s+(\d+)-', value, re.I)
+	if m:
+		return int(m.group(1))
+	return None
+
+# Header callback of a resumable transfer. A fresh download records the
+# version of the asset before its body is written. A resumed request is
+# aborted before any of the body is written unless the server sent exactly
+# the missing bytes: a '206' whose Content-Range starts at the end of the
+# partial file. c.stale tells resume_refused() to start over.
+def resume_headers(c, local_filename):
+	fields = {}
+	c.status = 0
+	c.stale = False
+	def header(line):
+		line = line.decode('iso-8859-1')
+		m = re.match(r'HTTP/\S+\s+(\d+)', line)
+		if m:
+			c.status = int(m.group(1))
+			fields.clear()
+			return
+		if ':' in line:
+			name, value = line.split(':', 1)
+			fields[name.strip().lower()] = value.strip()
+			return
+		if line.strip() or c.status >= 300:
+			return
+		# End of the headers, the body comes next
+		if c.offset == 0:
+			validator_save(local_filename, reply_validator(fields.get('etag'), fields.get('last-modified')))
+		elif c.status != 206 or content_range_start(fields.get('content-range', '')) != c.offset:
+			c.stale = True
+			return 0
+	return header
+
+# Open the partial file and ask the server for the remaining bytes only
+def resume_open(c, local_filename):
+	offset = resume_offset(local_filename)
+	headers = c.headers
+	if offset > 0:
+		validator = validator_load(local_filename)
+		if validator is None:
+			log.info('No version recorded for ' + os.path.basename(local_filename) + '.part, downloading from the start')
+			offset = 0
+		elif validator:
+			headers = headers + ['If-Range:' + validator]
+	if offset > 0:
+		fp = open(part_filename(local_filename), 'ab')
+		log.info('Resuming ' + os.path.basename(local_filename) + ' from byte ' + str(offset))
+	else:
+		fp = open(part_filename(local_filename), 'wb')
+	c.setopt(c.RESUME_FROM_LARGE, offset)
+	c.setopt(c.HTTPHEADER, headers)
+	c.offset = offset
+	c.setopt(c.HEADERFUNCTION, resume_headers(c, local_filename))
+	return fp
+
+# The transfer completed, move the partial file to its real name
+def resume_complete(local_filename):
+	os.replace(part_filename(local_filename), local_filename)
+	ranges_discard(local_filename)
+	validator_discard(local_filename)
+
+# The server can't continue the partial file (no range support, the range
+# is past the end of the file, or the asset changed since); the asset has to
+# be fetched from the start. libcurl reports a 416 reply to a resumed request
+# as a successful transfer, so this is checked for finished transfers too.
+def resume_refused(c, errno=None):
+	if c.offset == 0:
+		return False
+	if c.stale:
+		return True
+	if errno in (pycurl.E_RANGE_ERROR, pycurl.E_BAD_DOWNLOAD_RESUME):
+		return True
+	return c.getinfo(c.RESPONSE_CODE) == 416
+
+# Throw away a partial file that can't be resumed
+def resume_discard(local_filename):
+	part = part_filename(local_filename)
+	if os.path.isfile(part):
+		os.remove(part)
+	ranges_discard(local_filename)
+	validator_discard(local_filename)
+
+# A hedged request (see hedge.py) downloads the whole asset again into its
+# own file, next to the partial file of the original request
+def hedge_filename(local_filename):
+	return local_filename + '.hedge'
+
+# The hedge finished first, its file replaces the partial download
+def hedge_complete(local_filename):
+	os.replace(hedge_filename(local_filename), local_filename)
+	resume_discard(local_filename)
+
+def hedge_discard(local_filename):
+	hedge = hedge_filename(local_filename)
+	if os.path.isfile(hedge):
+		os.remove(hedge)
+
+# Bytes and average speed of a transfer as integers. The double variants
+# are deprecated, older pycurl builds only have those.
+info_size_download = getattr(pycurl, 'SIZE_DOWNLOAD_T', pycurl.SIZE_DOWNLOAD)
+info_speed_download = getattr(pycurl, 'SPEED_DOWNLOAD_T', pycurl.SPEED_DOWNLOAD)
+
+# Transfer details of a finished curl handle for on_complete()
+def curl_info(c):
+	return transfer_info(
+		total_time=c.getinfo(c.TOTAL_TIME),
+		ttfb=c.getinfo(c.STARTTRANSFER_TIME),
+		size=c.getinfo(info_size_download),
+		http_code=c.getinfo(c.RESPONSE_CODE),
+		primary_ip=c.getinfo(c.PRIMARY_IP),
+		namelookup_time=c.getinfo(c.NAMELOOKUP_TIME),
+		connect_time=c.getinfo(c.CONNECT_TIME),
+		appconnect_time=c.getinfo(c.APPCONNECT_TIME),
+		speed=c.getinfo(info_speed_download))
+
+# Blocking download of one asset on an easy handle, continuing a partial
+# file if there is one. Raises pycurl.error if the transfer fails.
+def download_file(c, local_filename):
+	while True:
+		fp = resume_open(c, local_filename)
+		c.setopt(c.WRITEFUNCTION, throttled_writer(fp.write))
+		wait_request(c.hostname)
+		try:
+			c.perform()
+		except pycurl.error as e:
+			fp.close()
+			if resume_refused(c, e.args[0]):
+				log.info('Server refused to resume ' + os.path.basename(local_filename) + ', downloading from the start')
+				resume_discard(local_filename)
+				continue
+			raise
+		fp.close()
+		if resume_refused(c):
+			log.info('Server refused to resume ' + os.path.basename(local_filename) + ', downloading from the start')
+			resume_discard(local_filename)
+			continue
+		resume_complete(local_filename)
+		return
+
+# Run a blocking download, retrying the failures the retry policy allows.
+# 'download' is called without arguments and raises pycurl.error on failure.
+# Returns [ok, attempts, error, stalls, result], where error is the message
+# of the last failed attempt ('' if there was none), stalls the number of
+# attempts aborted by the stall detection and result what the successful
+# download() returned (None on failure).
+def download_retry(retry, url, download):
+	attempts = 0
+	stalls = 0
+	error = ''
+	while True:
+		attempts += 1
+		try:
+			result = download()
+			return [True, attempts, error, stalls, result]
+		except pycurl.error as e:
+			error = e.args[1] if len(e.args) > 1 else str(e)
+			if stalled(e.args[0], error):
+				log.info('Transfer stalled, aborted ' + url)
+				stalls += 1
+			delay = None
+			if retry is not None:
+				delay = retry.next_delay(attempts, error_http_code(error), e.args[0])
+			if delay is None:
+				return [False, attempts, error, stalls, None]
+			log.info('Retrying ' + url + ' in ' + '%0.1f' % delay + ' seconds (attempt ' + str(attempts + 1) + '): ' + error)
+			time.sleep(delay)
+
+#-----------------------------------------------------------------------#
+# Segmented Downloads
+#-----------------------------------------------------------------------#
+
+# Ask for the first byte of the asset. A '206 Partial Content' reply with a
+# Content-Range header proves the server serves byte ranges and gives the
+# total size. Returns the size in bytes, or 0 if ranges are not available,
+# and the version of the asset (see reply_validator()).
+def probe_ranges(c):
+	headers = []
+	received = [0]
+	# A server without range support replies with the whole file, stop
+	# reading as soon as more than the one byte asked for arrives
+	def write(data):
+		received[0] += len(data)
+		if received[0] > 1:
+			return 0
+	c.setopt(c.RANGE, '0-0')
+	c.setopt(c.HEADERFUNCTION, headers.append)
+	c.setopt(c.WRITEFUNCTION, write)
+	wait_request(c.hostname)
+	try:
+		c.perform()
+	except pycurl.error as e:
+		if e.args[0] != pycurl.E_WRITE_ERROR:
+			raise
+		return 0, ''
+	finally:
+		c.unsetopt(c.RANGE)
+		c.unsetopt(c.HEADERFUNCTION)
+	if c.getinfo(c.RESPONSE_CODE) != 206:
+		return 0, ''
+	size = 0
+	fields = {}
+	for header in headers:
+		m = re.match(rb'content-range:\s*bytes\s+0-0/(\d+)', header, re.I)
+		if m:
+			size = int(m.group(1))
+		m = re.match(rb'(etag|last-modified):(.*)', header, re.I)
+		if m:
+			fields[m.group(1).decode().lower()] = m.group(2).decode('iso-8859-1').strip()
+	return size, reply_validator(fields.get('etag'), fields.get('last-modified'))
+
+# Split 'size' bytes into 'parts' inclusive byte ranges
+def byte_ranges(size, parts):
+	ranges = []
+	chunk = -(-size // parts)
+	start = 0
+	while start < size:
+		end = min(start + chunk, size) - 1
+		ranges.append((start, end))
+		start = end + 1
+	return ranges
+
+# Header callback that keeps the HTTP status of the reply in c.status,
+# getinfo() can't be called while the transfer runs
+def range_status(c):
+	c.status = 0
+	def header(line):
+		m = re.match(rb'HTTP/\S+\s+(\d+)', line)
+		if m:
+			c.status = int(m.group(1))
+	return header
+
+# Write callback that puts the body of the range of handle 'c' at its offset
+# in the file, after the c.written bytes already there. Returning 0 aborts
+# the transfer if the server sends more than was asked for, or sends
+# anything but the range (a 200 reply starts at byte 0 of the asset).
+def range_writer(c, fd):
+	start, end = c.span
+	def write(data):
+		if c.status != 206:
+			return 0
+		offset = start + c.written[0]
+		if offset + len(data) > end + 1:
+			return 0
+		os.pwrite(fd, data, offset)
+		c.written[0] += len(data)
+	return write
+
+# A segmented download keeps the bytes written so far of each of its ranges
+# next to the preallocated partial file, '<file>.ranges': the size and the
+# version (see validator_filename()) of the asset on the first line, then
+# 'start end written' per range. The partial file has holes, so its size
+# says nothing about what is downloaded.
+def ranges_filename(local_filename):
+	return local_filename + '.ranges'
+
+# The ranges of an interrupted segmented download of an asset of 'size'
+# bytes as [(start, end, [written])], None if there is nothing to continue
+# or the asset is not the 'validator' version any more
+def ranges_load(local_filename, size, validator):
+	part = part_filename(local_filename)
+	try:
+		with open(ranges_filename(local_filename)) as f:
+			lines = f.read().split('\n')
+		fields = lines[0].split(' ', 1) + ['']
+		if int(fields[0]) != size or fields[1] != validator or os.path.getsize(part) != size:
+			return None
+		spans = []
+		for line in lines[1:]:
+			if line:
+				start, end, written = [int(value) for value in line.split()]
+				spans.append((start, end, [min(written, end - start + 1)]))
+		return spans
+	except (OSError, ValueError):
+		return None
+
+# Record the progress of every range, the old record is replaced in one rename
+def ranges_save(local_filename, size, validator, spans):
+	ranges = ranges_filename(local_filename)
+	with open(ranges + '.tmp', 'w') as f:
+		f.write(str(size) + ' ' + validator + '\n')
+		for start, end, written in spans:
+			f.write(str(start) + ' ' + str(end) + ' ' + str(written[0]) + '\n')
+	os.replace(ranges + '.tmp', ranges)
+
+def ranges_discard(local_filename):
+	ranges = ranges_filename(local_filename)
+	if os.path.isfile(ranges):
+		os.remove(ranges)
+
+# Download one large asset over several connections at once. The file is
+# probed for its size, preallocated, then every byte range is fetched on its
+# own connection and written at its offset. Falls back to a normal download
+# when the asset is smaller than 'min_size' or the server has no range support.
+# The progress of each range is saved as it downloads (see ranges_filename()),
+# a failed or interrupted download continues with the bytes still missing.
+# Returns the transfer details (see transfer_info()), raises pycurl.error if
+# the transfer fails.
+def download_segmented(url, local_filename, parts, min_size, pool):
+	c = pool.get(url)
+	try:
+		size = 0
+		validator = ''
+		if parts > 1:
+			size, validator = probe_ranges(c)
+			pool.record(c)
+		if size < max(min_size, parts):
+			# A preallocated partial file can't be continued from its end
+			if os.path.isfile(ranges_filename(local_filename)):
+				resume_discard(local_filename)
+			download_file(c, local_filename)
+			pool.record(c)
+			return curl_info(c)
+	finally:
+		pool.put(c)
+
+	part = part_filename(local_filename)
+	spans = ranges_load(local_filename, size, validator)
+	if spans is None:
+		log.info('Downloading ' + os.path.basename(local_filename) + ' (' + str(size) + ' bytes) in ' + str(parts) + ' ranges')
+		spans = [(start, end, [0]) for start, end in byte_ranges(size, parts)]
+		fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+	else:
+		done = sum([written[0] for start, end, written in spans])
+		log.info('Resuming ' + os.path.basename(local_filename) + ' (' + str(size) + ' bytes) in ' + str(len(spans)) + ' ranges, ' + str(size - done) + ' bytes missing')
+		fd = os.open(part, os.O_WRONLY)
+	multi = pycurl.CurlMulti()
+	handles = []
+	failed = None
+	start_time = time.monotonic()
+	try:
+		if os.fstat(fd).st_size != size:
+			if hasattr(os, 'posix_fallocate'):
+				os.posix_fallocate(fd, 0, size)
+			else:
+				os.ftruncate(fd, size)
+		ranges_save(local_filename, size, validator, spans)
+		last_save = time.monotonic()
+		for start, end, written in spans:
+			# Ask only for the bytes of the range still missing
+			if written[0] == end - start + 1:
+				continue
+			c = pool.get(url)
+			c.written = written
+			c.span = (start, end)
+			c.setopt(c.RANGE, str(start + written[0]) + '-' + str(end))
+			# A changed asset replies 200 and the range writer refuses it
+			if validator:
+				c.setopt(c.HTTPHEADER, c.headers + ['If-Range:' + validator])
+			c.setopt(c.HEADERFUNCTION, range_status(c))
+			c.setopt(c.WRITEFUNCTION, throttled_writer(range_writer(c, fd)))
+			wait_request(c.hostname)
+			multi.add_handle(c)
+			handles.append(c)
+		num_handles = len(handles)
+		while num_handles and failed is None:
+			ret, num_handles = multi.perform()
+			if ret == pycurl.E_CALL_MULTI_PERFORM:
+				continue
+			# One failed range fails the whole asset
+			while True:
+				num_q, ok_list, err_list = multi.info_read()
+				for c, errno, errmsg in err_list:
+					if failed is None:
+						failed = pycurl.error(errno, errmsg)
+				if num_q == 0:
+					break
+			if time.monotonic() - last_save >= 1.0:
+				ranges_save(local_filename, size, validator, spans)
+				last_save = time.monotonic()
+			if num_handles and failed is None:
+				multi.select(1.0)
+		# Every range must have come back complete as a partial content reply
+		if failed is None:
+			for c in handles:
+				start, end = c.span
+				if c.getinfo(c.RESPONSE_CODE) != 206 or c.written[0] != end - start + 1:
+					failed = pycurl.error(pycurl.E_PARTIAL_FILE, 'Range ' + str(start) + '-' + str(end) + ' incomplete')
+					break
+			total = sum([written[0] for start, end, written in spans])
+			if failed is None and total != size:
+				failed = pycurl.error(pycurl.E_PARTIAL_FILE, 'Expected ' + str(size) + ' bytes, received ' + str(total))
+			if failed is None:
+				# The whole asset, with the connection times of the first range
+				info = transfer_info(time.monotonic() - start_time, None, size)
+				if len(handles) > 0:
+					first = curl_info(handles[0])
+					info = transfer_info(time.monotonic() - start_time, first['ttfb'], size, first['http_code'], first['primary_ip'], first['namelookup_time'], first['connect_time'], first['appconnect_time'])
+	except OSError as e:
+		failed = pycurl.error(pycurl.E_WRITE_ERROR, str(e))
+	finally:
+		for c in handles:
+			multi.remove_handle(c)
+			c.unsetopt(c.HEADERFUNCTION)
+			pool.record(c)
+			pool.put(c)
+		multi.close()
+		os.close(fd)
+		# Keep what the ranges wrote, the next attempt asks for the rest
+		if failed is not None:
+			try:
+				ranges_save(local_filename, size, validator, spans)
+			except OSError:
+				pass
+	if failed is not None:
+		raise failed
+	resume_complete(local_filename)
+	return info
+
+#-----------------------------------------------------------------------#
+# Download Engines
+#-----------------------------------------------------------------------#
+
+# Runs a list of download jobs through one CurlMulti handle.
+# Partial files left by an earlier run or a failed transfer are continued
+# with a Range request.
+class MultiDownloader(Transport):
+
+	name = 'curl'
+
+	def __init__(self, concurrency, debug=False, pool=None, controller=None, retry=None, hedge=None, keeper=None):
+		Transport.__init__(self, concurrency, debug, controller, retry, hedge, keeper)
+		if pool is None:
+			pool = get_pool(debug)
+		self.pool = pool
+		self.multi = pycurl.CurlMulti()
+		self.active = []
+		# Transfers paused by the bandwidth cap, as (resume time, seq, handle)
+		self.held = []
+		self.holds = 0
+
+	# Attach a job to a curl handle from the pool
+	def start(self, job):
+		asset, url, local_filename = job
+		c = self.pool.get(url)
+		try:
+			c.fp = resume_open(c, local_filename)
+		except OSError:
+			self.pool.put(c)
+			raise
+		c.job = job
+		c.started = time.monotonic()
+		c.partner = None
+		c.is_hedge = False
+		c.cancelled = False
+		c.held = None
+		c.setopt(c.WRITEFUNCTION, paced_writer(self.leased_writer(c.fp.write), lambda delay: self.hold(c, delay)))
+		self.multi.add_handle(c)
+		self.active.append(c)
+		if self.hedge is not None:
+			self.hedge.start()
+
+	# Send the request of a slow transfer again on another connection, the
+	# copy downloads the whole asset into its own file. A hedge is a real
+	# transfer and takes a slot like any other.
+	def start_hedge(self, c):
+		job = c.job
+		h = self.pool.get(job[1])
+		try:
+			h.fp = open(hedge_filename(job[2]), 'wb')
+		except OSError:
+			self.pool.put(h)
+			return
+		h.offset = 0
+		h.job = job
+		h.started = time.monotonic()
+		h.partner = c
+		h.is_hedge = True
+		h.cancelled = False
+		h.held = None
+		c.partner = h
+		h.setopt(h.WRITEFUNCTION, paced_writer(self.leased_writer(h.fp.write), lambda delay: self.hold(h, delay)))
+		self.multi.add_handle(h)
+		self.active.append(h)
+		log.info('Hedging slow transfer ' + job[1] + ', no reply after ' + '%0.2f' % (h.started - c.started) + ' seconds')
+
+	# Hedge every transfer still waiting for its first byte past the
+	# threshold, as far as the budget allows
+	def check_hedges(self):
+		threshold = self.hedge.threshold()
+		if threshold is None:
+			return
+		now = time.monotonic()
+		for c in list(self.active):
+			if c.is_hedge or c.partner is not None or now - c.started < threshold:
+				continue
+			if c.getinfo(c.STARTTRANSFER_TIME) > 0:
+				continue
+			if not self.hedge.allow():
+				return
+			self.start_hedge(c)
+
+	# The bandwidth cap is used up: pause the transfer that went over it, from
+	# its write callback, instead of sleeping in perform() and holding back
+	# every transfer, the lease renewal and the hedge checks. run() lets it
+	# continue once the delay has passed.
+	def hold(self, c, delay):
+		c.pause(pycurl.PAUSE_RECV)
+		self.holds += 1
+		c.held = self.holds
+		heapq.heappush(self.held, (time.monotonic() + delay, c.held, c))
+
+	# Continue the paused transfers whose delay has passed. A transfer that
+	# ended or was paused again since has another c.held and is skipped.
+	def release_held(self):
+		now = time.monotonic()
+		while self.held and self.held[0][0] <= now:
+			held = heapq.heappop(self.held)
+			c = held[2]
+			if c.held != held[1]:
+				continue
+			c.held = None
+			c.pause(pycurl.PAUSE_CONT)
+
+	# Stop the losing copy of a hedged transfer, or a transfer whose lease was
+	# lost. Its own message may already be in the batch read from
+	# info_read(), c.cancelled tells run() to skip it.
+	def cancel(self, c):
+		c.cancelled = True
+		c.held = None
+		self.multi.remove_handle(c)
+		self.active.remove(c)
+		c.fp.close()
+		if c.is_hedge:
+			hedge_discard(c.job[2])
+		c.job = None
+		c.partner = None
+		self.pool.put(c)
+
+	# Detach a finished transfer and hand the handle back to the pool
+	def finish(self, c):
+		c.held = None
+		self.multi.remove_handle(c)
+		self.active.remove(c)
+		c.fp.close()
+		self.pool.record(c)
+		job = c.job
+		c.job = None
+		c.partner = None
+		return job
+
+	# Start a job, a job that can't even be started counts as failed
+	def launch(self, job, on_failed):
+		try:
+			self.start(job)
+		except (OSError, pycurl.error) as e:
+			self.failure(job, str(e), permanent=True)
+			self.fail(job, str(e), on_failed)
+			return False
+		log.debug('Transfer started: ' + job[1])
+		return True
+
+	def run(self, jobs, on_complete, on_failed):
+		queue = deque(jobs)
+		num_jobs = len(queue)
+		num_done = 0
+		limiter = get_limiter()
+		# Jobs held back by the per-host request rate or waiting to be
+		# retried, as (start time, seq, job). They keep their slot.
+		waiting = []
+		seq = 0
+		while num_done < num_jobs:
+			# Stop everything of the assets another process owns now, before
+			# perform() writes anything more of them
+			lost = self.lost_assets()
+			if lost:
+				dropped = set()
+				for c in list(self.active):
+					if c.job[0] in lost:
+						dropped.add(c.job)
+						self.cancel(c)
+				for item in waiting:
+					if item[2][0] in lost:
+						dropped.add(item[2])
+				waiting = [item for item in waiting if item[2][0] not in lost]
+				heapq.heapify(waiting)
+				for job in queue:
+					if job[0] in lost:
+						dropped.add(job)
+				queue = deque([job for job in queue if job[0] not in lost])
+				for job in dropped:
+					self.drop(job)
+				num_done += len(dropped)
+				if num_done >= num_jobs:
+					break
+			now = time.monotonic()
+			while waiting and waiting[0][0] <= now and len(self.active) < self.slots():
+				job = heapq.heappop(waiting)[2]
+				if not self.launch(job, on_failed):
+					num_done += 1
+			# Fill every free slot from the queue
+			while queue and len(self.active) + len(waiting) < self.slots():
+				job = queue.popleft()
+				if limiter is not None:
+					delay = limiter.request_delay(url_hostname(job[1]))
+					if delay > 0:
+						seq += 1
+						heapq.heappush(waiting, (now + delay, seq, job))
+						continue
+				if not self.launch(job, on_failed):
+					num_done += 1
+			self.release_held()
+			# Run the internal curl state machine
+			while True:
+				ret, num_handles = self.multi.perform()
+				if ret != pycurl.E_CALL_MULTI_PERFORM:
+					break
+			# Collect finished transfers
+			while True:
+				num_q, ok_list, err_list = self.multi.info_read()
+				for c in ok_list:
+					# The copy that lost to its partner earlier in this batch
+					if c.cancelled:
+						continue
+					partner = c.partner
+					job = self.finish(c)
+					if resume_refused(c):
+						log.info('Server refused to resume ' + job[1] + ', downloading from the start')
+						resume_discard(job[2])
+						# A running hedge is already downloading from the start
+						if partner is not None:
+							partner.partner = None
+						else:
+							queue.appendleft(job)
+						self.pool.put(c)
+						continue
+					# First copy of a hedged transfer to finish wins
+					if partner is not None:
+						self.cancel(partner)
+					try:
+						if c.is_hedge:
+							hedge_complete(job[2])
+							self.hedge.hedge_won()
+						else:
+							resume_complete(job[2])
+					except OSError as e:
+						num_done += 1
+						self.failure(job, str(e), permanent=True)
+						self.fail(job, str(e), on_failed)
+						self.pool.put(c)
+						continue
+					num_done += 1
+					info = curl_info(c)
+					self.observe(info)
+					self.complete(job, info, on_complete)
+					self.pool.put(c)
+				for c, errno, errmsg in err_list:
+					if c.cancelled:
+						continue
+					partner = c.partner
+					job = self.finish(c)
+					if stalled(errno, errmsg):
+						log.info('Transfer stalled, aborted ' + job[1])
+						self.stalls += 1
+					if c.is_hedge:
+						hedge_discard(job[2])
+					# The other copy of a hedged transfer carries on alone
+					if partner is not None:
+						log.debug('Hedged copy of ' + job[1] + ' failed: ' + errmsg)
+						partner.partner = None
+						self.pool.put(c)
+						continue
+					# Held up past the lease, keep() finds out if it is still ours
+					if errno == pycurl.E_WRITE_ERROR and not self.leased():
+						queue.appendleft(job)
+						self.pool.put(c)
+						continue
+					if resume_refused(c, errno):
+						log.info('Server refused to resume ' + job[1] + ', downloading from the start')
+						resume_discard(job[2])
+						queue.appendleft(job)
+						self.pool.put(c)
+						continue
+					http_code = c.getinfo(c.RESPONSE_CODE)
+					self.observe(http_code=http_code)
+					delay = self.failure(job, errmsg, http_code, errno)
+					if delay is None:
+						num_done += 1
+						self.fail(job, errmsg, on_failed)
+					else:
+						if limiter is not None:
+							delay = max(delay, limiter.request_delay(url_hostname(job[1])))
+						seq += 1
+						heapq.heappush(waiting, (time.monotonic() + delay, seq, job))
+					self.pool.put(c)
+				if num_q == 0:
+					break
+			if self.hedge is not None:
+				self.check_hedges()
+			# Wait for activity on any of the sockets, or the next held back
+			# job or paused transfer
+			if num_done < num_jobs:
+				timeout = 1.0
+				if self.hedge is not None:
+					timeout = hedge_interval
+				if waiting:
+					timeout = max(0, min(timeout, waiting[0][0] - time.monotonic()))
+				if self.held:
+					timeout = max(0, min(timeout, self.held[0][0] - time.monotonic()))
+				if self.active:
+					self.multi.select(timeout)
+				else:
+					time.sleep(timeout)
+		return num_done
+
+	def summary(self):
+		return self.pool.summary()
+
+	def close(self):
+		for c in list(self.active):
+			self.multi.remove_handle(c)
+			c.fp.close()
+			if c.is_hedge:
+				hedge_discard(c.job[2])
+			c.close()
+		self.active = []
+		self.multi.close()
+
+# Worker process setup: a fresh curl handle pool, the parent's rate limiter,
+# the stop flags of the jobs of the run and the lease deadline
+def process_init(rate_limiter, stop=None, deadline=None):
+	global stop_flags, lease_deadline
+	forget_pool()
+	set_limiter(rate_limiter)
+	stop_flags = stop
+	lease_deadline = deadline
+
+# Stop flags of the jobs of the run, one byte per job, set by the parent
+# when the lease of the job's asset was lost
+stop_flags = None
+# time.monotonic() time until which the parent surely holds its leases,
+# moved on by the parent as it renews them. Past it nothing is written.
+lease_deadline = None
+
+def stopped(index):
+	return stop_flags is not None and stop_flags[index] != 0
+
+def leased():
+	return lease_deadline is None or time.monotonic() < lease_deadline.value
+
+# The transfer of a job was stopped by the parent
+class TransferStopped(Exception):
+	pass
+
+# Worker side of ProcessDownloader, runs in a pool process with that
+# process' own curl handle pool. Retries wait in the worker. A running
+# transfer checks the job's stop flag and the lease deadline from the curl
+# progress callback. A transfer held back by the deadline waits for the
+# parent to renew the leases and resumes its partial file.
+def process_download(args):
+	index, url, local_filename, debug, retry = args
+	pool = get_pool(debug)
+	c = pool.get(url)
+	c.setopt(c.NOPROGRESS, False)
+	c.setopt(c.XFERINFOFUNCTION, lambda *totals: 0 if leased() and not stopped(index) else 1)
+	def download():
+		while True:
+			if stopped(index):
+				raise TransferStopped()
+			if not leased():
+				time.sleep(0.1)
+				continue
+			try:
+				download_file(c, local_filename)
+				return
+			except pycurl.error:
+				if stopped(index) or not leased():
+					continue
+				raise
+			finally:
+				pool.record(c)
+	try:
+		ok, attempts, error, stalls, result = download_retry(retry, url, download)
+	except OSError as e:
+		ok, attempts, error, stalls = False, 1, str(e), 0
+	except TransferStopped:
+		ok, attempts, error, stalls = None, 0, '', 0
+	if ok:
+		info = curl_info(c)
+		info['attempts'] = attempts
+		info['last_error'] = error or None
+		result = [index, True, info, attempts, stalls]
+	else:
+		result = [index, ok, error, attempts, stalls]
+	c.setopt(c.NOPROGRESS, True)
+	pool.put(c)
+	result.append(os.getpid())
+	result.append(pool.summary())
+	return result
+
+# Runs a list of download jobs on a multiprocessing pool, one blocking
+# transfer per worker process. Callbacks run in the calling process.
+# Each run has its own pool, the workers inherit the run's stop flags.
+class ProcessDownloader(Transport):
+
+	name = 'process'
+
+	def __init__(self, concurrency, debug=False, retry=None, keeper=None):
+		Transport.__init__(self, concurrency, debug, retry=retry, keeper=keeper)
+		self.stats = {}
+
+	def run(self, jobs, on_complete, on_failed):
+		args = []
+		for index, job in enumerate(jobs):
+			args.append((index, job[1], job[2], self.debug, self.retry))
+		stop = multiprocessing.Array('b', max(1, len(jobs)), lock=False)
+		deadline = None
+		if self.keeper is not None:
+			deadline = multiprocessing.Value('d', self.keeper.deadline(), lock=False)
+		workers = multiprocessing.Pool(self.concurrency, initializer=process_init, initargs=(get_limiter(), stop, deadline))
+		num_done = 0
+		try:
+			results = workers.imap_unordered(process_download, args)
+			while num_done < len(jobs):
+				# Wake up at least once a second to keep the leases
+				try:
+					index, ok, result, attempts, stalls, pid, stats = results.next(timeout=1.0)
+				except multiprocessing.TimeoutError:
+					index = None
+				lost = self.lost_assets()
+				for i, job in enumerate(jobs):
+					if job[0] in lost:
+						stop[i] = 1
+				if deadline is not None:
+					deadline.value = self.keeper.deadline()
+				if index is None:
+					continue
+				# Each worker reports the running totals of its own curl pool
+				self.stats[pid] = stats
+				num_done += 1
+				# A job that finished after its lease was lost is not ours to report
+				if ok is None or stop[index]:
+					self.drop(jobs[index])
+					continue
+				asset = jobs[index][0]
+				self.retries += attempts - 1
+				self.stalls += stalls
+				if ok:
+					on_complete(asset, result)
+				else:
+					self.failed += 1
+					on_failed(asset, result, attempts)
+		finally:
+			workers.close()
+			workers.join()
+		return num_done
+
+	def summary(self):
+		transfers = 0
+		reused = 0
+		for stats in self.stats.values():
+			transfers += stats[0]
+			reused += stats[1]
+		return [transfers, reused]
@@ -31,8 +31,29 @@ import logging.handlers
 import configparser
 import getopt
 # Third-Party
-import sqlite3
 import pycurl
+# Curl Handle Pool
+from curl_pool import get_pool, reuse_summary, set_stall_limits, stall_summary
+# Resumable Downloads
+from downloader import download_segmented, download_retry, part_filename, ranges_discard, validator_discard
+# Adaptive Concurrency
+from concurrency import AimdController, error_http_code
+# Rate Limits
+from ratelimit import RateLimiter, set_limiter
+# Retries
+from retry import RetryPolicy, retry_summary
+# Stream Combine
+from combine import Combiner
+# Virtual Stream
+from serve import VirtualStream, serve_stream, write_playlist, stream_path
+# Playlist Import
+from importer import import_playlist, import_summary
+# Database
+from db import close_db, db_check_exists, db_get_job, db_list_jobs, default_job, job_storage_path, db_purge, db_status_counts, db_get_status, db_iter_status, db_sequence_gaps, gaps_msg, delete_asset_db
+# Ingest Status, the same in every script
+from db import status_new, status_queued, status_completed, status_failed
+# Database Writer
+from writer import DbWriter, set_writer, post_transition
 
 
 ### Functions
@@ -64,13 +85,6 @@ def delete_asset(path):
         return False
     return True
 
-def delete_asset_db(asset):
-    conn = sqlite3.connect(database)
-    c = conn.cursor()
-    c.execute("DELETE FROM assets WHERE id=?", (int(asset),))
-    conn.commit()
-    conn.close()
-
 def duration_msg(duration,message):
     duration = round(duration,3)
     if duration < 1:
@@ -140,82 +154,24 @@ def csv_asset_failed(pid_aid,csvfile,error):
         f.write(pid_aid + ',' + error +'\n')
     f.close()
 
-# create the database if not present
-def db_check_exists(database):
-    sql = """ CREATE TABLE "assets" (
-        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-        asset TEXT NOT NULL DEFAULT "",
-        asset_uri TEXT NOT NULL DEFAULT "",
-        status INTEGER NOT NULL DEFAULT 0
-    ); """
-    exists = os.path.isfile(database)
-    if exists:
-        #print('Database ' + database + ' already created.')
-        return True
-    else:
-        print();print('Database ' + database + ' missing, creating new database.')
-        conn = sqlite3.connect(database)
-        c = conn.cursor()
-        c.execute(sql)
-        conn.commit()
-        conn.close()
-        print();print('Database ' + database + ' created.')
-        return True
+# Local file name of an asset url
+def asset_name(asset_uri):
+    return asset_uri.split('/')[-1]
 
 def db_asset_importer(database,inputfile):
-    asset_count = 0
-    conn = sqlite3.connect(database)
-    c = conn.cursor()
-    #log.info('Asset file: ' + inputfile)
-    f=open(inputfile,'r')
-    for line in f.readlines():
-        if (not line in ['\n','\r\n']):
-            if line.startswith('http') or line.startswith('https'):
-                asset = (line.split('/')[-1]).strip();print("[" + str(asset_count+1) + "] " + asset)
-                asset_uri = line.strip();print(asset_uri)
-                c.execute("INSERT INTO assets (asset,asset_uri) \
-                    VALUES (?,?)", (asset,asset_uri))
-                asset_count+=1
-    f.close()
-    conn.commit()
-    conn.close()
-    print();print('There were '+str(asset_count)+' assets imported from file ' + inputfile + '.');print()
+    inserted, skipped, duration = import_playlist(database, inputfile, asset_name, job)
+    print();print(import_summary(inserted, skipped, duration, inputfile));print()
 
 
 def get_inventory_print(database):
+    inventory = db_get_inventory(database)
     print('--------------------------------')
     print('Assets Database:')
-
-    assets_new = []
-    assets_queued = []
-    assets_completed = []
-    assets_failed = []
-
-    conn = sqlite3.connect(database)
-    # New
-    c = conn.cursor()
-    c.execute("SELECT * FROM assets WHERE status=0")
-    assets_new = c.fetchall()
-    print('New       = ' + str(len(assets_new)))
-    # Queued
-    c = conn.cursor()
-    c.execute("SELECT * FROM assets WHERE status=1")
-    assets_queued = c.fetchall()
-    print('Queued    = ' + str(len(assets_queued)))
-    # Failed
-    c = conn.cursor()
-    c.execute("SELECT * FROM assets WHERE status=6")
-    assets_failed = c.fetchall()
-    print('Failed    = ' + str(len(assets_failed)))
-    # Completed
-    c = conn.cursor()
-    c.execute("SELECT * FROM assets WHERE status=7")
-    assets_completed = c.fetchall()
-    print('Completed = ' + str(len(assets_completed)))
-
-    conn.close()
+    print('New       = ' + str(inventory[0]))
+    print('Queued    = ' + str(inventory[1]))
+    print('Failed    = ' + str(inventory[3]))
+    print('Completed = ' + str(inventory[2]))
     print('--------------------------------')
-#   return [assets_new, assets_queued, assets_completed, assets_failed]
 
 
 def delete_asset(path):
@@ -230,13 +186,6 @@ def delete_asset(path):
         return False
     return True
 
-def delete_asset_db(asset):
-    conn = sqlite3.connect(database)
-    c = conn.cursor()
-    c.execute("DELETE FROM assets WHERE id=?", (int(asset),))
-    conn.commit()
-    conn.close()
-
 def duration_msg(duration,message):
     duration = round(duration,3)
     if duration < 1:
@@ -298,112 +247,45 @@ def file_check_exists(inputfile):
 
 def print_assets(assets):
     for asset in assets:
-        print("[" + str(asset[0]) + "] " + asset[1] + " | " + asset[2] + " | " + str(asset[3]))
+        line = "[" + str(asset[0]) + "] " + asset[1] + " | " + asset[2] + " | " + str(asset[3])
+        if len(asset) > 5 and asset[5]:
+            line += " | " + str(asset[4]) + " attempts, last error: " + asset[5]
+        print(line)
+
+def print_jobs(database):
+    for job_id, name, created, count in db_list_jobs(database):
+        print('[' + str(job_id) + '] ' + name + ' | created ' + created + ' | ' + str(count) + ' assets')
 
 def print_help():
     print()
     print("Usage:")
     print("./stream.py -i <input-file>, where -i means 'import'. Imports the m3u8 playlist file into the tool database.")
-    print("./stream.py -p, where -p means 'purge'. Purges all assets from the assets database.")
+    print("./stream.py -p, where -p means 'purge'. Purges all assets from the assets database, or only the assets of the job given with -j.")
     print("./stream.py -d, where -d means 'delete'. Deletes Completed and Failed assets from the tool database.")
     print("./stream.py -l, where -l means 'list'. Prints all assets in the tool database.")
     print("./stream.py -s <output-file>, where -s means 'save'. Combines all video files and saves as a single transport stream.")
+    print("./stream.py -v <port>, where -v means 'virtual'. Serves all video files as a single transport stream at http://127.0.0.1:<port>/stream.ts, with nothing copied.")
+    print("./stream.py -j <name>, where -j means 'job'. Picks the job the other options work on, the default job without it.")
     print("./stream.py -h, where -h means 'help'. Prints this help information.")
     print("./stream.py, runs the download script.")
     print()
 
 def db_get_inventory_log(database):
+    inventory = db_get_inventory(database)
     log.info('--------------------------------')
     log.info('Assets Database:')
-
-    assets_new = []
-    assets_queued = []
-    assets_completed = []
-    assets_failed = []
-
-    conn = sqlite3.connect(database)
-    # New
-    c = conn.cursor()
-    c.execute("SELECT * FROM assets WHERE status=0")
-    assets_new = c.fetchall()
-    log.info('New       = ' + str(len(assets_new)))
-    # Queued
-    c = conn.cursor()
-    c.execute("SELECT * FROM assets WHERE status=1")
-    assets_queued = c.fetchall()
-    log.info('Queued    = ' + str(len(assets_queued)))
-    # Failed
-    c = conn.cursor()
-    c.execute("SELECT * FROM assets WHERE status=6")
-    assets_failed = c.fetchall()
-    log.info('Failed    = ' + str(len(assets_failed)))
-    # Completed
-    c = conn.cursor()
-    c.execute("SELECT * FROM assets WHERE status=7")
-    assets_completed = c.fetchall()
-    log.info('Completed = ' + str(len(assets_completed)))
-
-    conn.close()
+    log.info('New       = ' + str(inventory[0]))
+    log.info('Queued    = ' + str(inventory[1]))
+    log.info('Failed    = ' + str(inventory[3]))
+    log.info('Completed = ' + str(inventory[2]))
     log.info('--------------------------------')
-    return [assets_new, assets_queued, assets_completed, assets_failed]
+    return inventory
 
 
+# Number of assets in each status, [New, Queued, Completed, Failed]
 def db_get_inventory(database):
-    assets_new = []
-    assets_queued = []
-    assets_completed = []
-    assets_failed = []
-
-    conn = sqlite3.connect(database)
-    # New
-    c = conn.cursor()
-    c.execute("SELECT * FROM assets WHERE status=0")
-    assets_new = c.fetchall()
-    # Queued
-    c = conn.cursor()
-    c.execute("SELECT * FROM assets WHERE status=1")
-    assets_queued = c.fetchall()
-    # Failed
-    c = conn.cursor()
-    c.execute("SELECT * FROM assets WHERE status=6")
-    assets_failed = c.fetchall()
-    # Completed
-    c = conn.cursor()
-    c.execute("SELECT * FROM assets WHERE status=7")
-    assets_completed = c.fetchall()
-
-    conn.close()
-    return [assets_new, assets_queued, assets_completed, assets_failed]
-
-
-def db_update_asset_status(database,aid,status):
-    conn = sqlite3.connect(database)
-    c = conn.cursor()
-    c.execute("UPDATE assets SET status=? WHERE id=?", (status,aid))
-    conn.commit()
-    conn.close()
-
-def db_update_asset_status_asset(database,asset,status):
-    conn = sqlite3.connect(database)
-    c = conn.cursor()
-    c.execute("UPDATE assets SET status=? WHERE asset=?", (status,asset))
-    conn.commit()
-    conn.close()
-
-def db_purge(database):
-    sql = """ CREATE TABLE "assets" (
-        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-        asset TEXT NOT NULL DEFAULT "",
-        asset_uri TEXT NOT NULL DEFAULT "",
-        status INTEGER NOT NULL DEFAULT 0
-    ); """
-    conn = sqlite3.connect(database)
-    c = conn.cursor()
-    c.execute("DROP TABLE assets")
-    c.execute(sql)
-    conn.commit()
-    conn.close()
-    print();print('Database ' + database + ' purged.');print()
+    counts = db_status_counts(database,jobs)
+    return [counts.get(status_new,0), counts.get(status_queued,0), counts.get(status_completed,0), counts.get(status_failed,0)]
 
 
 # Download asset from target
@@ -413,61 +295,39 @@ def db_purge(database):
 #     urllib.request.urlretrieve(url, filename)
 #     q.put(filename)
 
-def download_target(url,assets_total):
-    hostname = url.split('/')[2]
-
-    headers = [
-        'Accept:application/octet-stream',
-        'Connection:keep-alive',
-        'Content-Type:application/gzip',
-        'Host:'+hostname,
-        'User-Agent:Python'
-    ]
-
-    c = pycurl.Curl()
-    c.fp = None
-    # these keepalive options are not available on CentOS.
-    # these options are kept here for reference.
-    #c.setopt(c.TCP_KEEPALIVE, True)
-    #c.setopt(c.TCP_KEEPINTVL, 30L)
-    #c.setopt(c.TCP_KEEPIDLE, 120L)
-    c.setopt(c.FOLLOWLOCATION, False)
-    c.setopt(c.CONNECTTIMEOUT, 10)
-    # The connection is dropped if the asset isn't downloaded within the c.TIMEOUT window.
-    #c.setopt(c.TIMEOUT, 60L)  # DO NOT set this timeout! 
-    c.setopt(c.NOSIGNAL, True)
-    #c.setopt(c.FORBID_REUSE, True)  # Disabled, reuse same TCP socket
-    c.setopt(c.FAILONERROR, True)
-    c.setopt(c.HTTPHEADER, headers)
-    c.setopt(c.NOPROGRESS, False)
-    if debug == True:
-        c.setopt(c.VERBOSE, True)
-    c.setopt(c.URL, url)
-    filename = url.split('/')[-1]
+# The curl handles come from this worker process' per-host pool and go back
+# to it afterwards, so the next asset from the same CDN host reuses the open
+# connections. Large files are split into byte ranges that are fetched on
+# parallel connections. Failures are retried after a backoff as the retry
+# policy allows.
+# The asset is saved under its file name in the database, 'filename', and
+# its state changes are sent to the writer by asset id 'aid'.
+# Returns [downloaded, transfers, connections reused, bytes, error message,
+# attempts, stall aborts].
+def download_target(aid,filename,url,assets_total):
+    pool = get_pool(debug)
+    transfers, reused = pool.summary()
     local_filename = os.path.join(storage_path, filename)
-    with open(local_filename, 'wb') as f:
-        #print();log.info("Downloading: " + filename)
-        #log.info("Downloading: ["+str(ingest_count)+"/"+str(assets_total)+"] " + filename)
-        c.setopt(c.WRITEFUNCTION, f.write)
-        try:
-            c.perform()
-            #log.info('Asset download  ' + filename + ' completed in %0.3f seconds' % c.getinfo(c.TOTAL_TIME))
-            db_update_asset_status_asset(database,filename,3)
-        except pycurl.error as e:
-            #log.info('Asset failed to download  ' + url)
-            db_update_asset_status_asset(database,filename,4)
-            #print('Status Code: %d' % c.getinfo(c.RESPONSE_CODE))
-            if e.args[0] == pycurl.E_COULDNT_CONNECT and c.exception:
-                log.error(c.exception)
-            else:
-                log.error(e)
-            f.close()
-            c.close()   
-            return False
-        finally:
-            f.close()
-            c.close()
-    return True
+    size = 0
+    #print();log.info("Downloading: " + filename)
+    #log.info("Downloading: ["+str(ingest_count)+"/"+str(assets_total)+"] " + filename)
+    # Continues a partial file from an earlier failed attempt
+    downloaded, attempts, error, stalls, info = download_retry(retry, url, lambda: download_segmented(url, local_filename, segment_parts, segment_min_size, pool))
+    if downloaded:
+        #log.info('Asset download  ' + filename + ' completed in %0.3f seconds' % c.getinfo(c.TOTAL_TIME))
+        post_transition(aid,status_completed,attempts,error or None,info)
+        size = os.path.getsize(local_filename)
+    else:
+        #log.info('Asset failed to download  ' + url)
+        post_transition(aid,status_failed,attempts,error)
+        log.error(error)
+    stats = pool.summary()
+    return [downloaded, stats[0] - transfers, stats[1] - reused, size, error, attempts, stalls]
+
+# Runs in each worker process when it starts
+def init_worker(rate_limiter,writer_queue):
+    set_limiter(rate_limiter)
+    set_writer(writer_queue)
 
 ### End of Functions
 
@@ -484,9 +344,18 @@ if __name__ == "__main__":
     database = config.get('tool', 'database')
     storage_path = config.get('tool', 'storage_path')
     http_timeout = int(config.get('tool', 'http_timeout'))
+    stall_min_speed = int(config.get('tool', 'stall_min_speed'))
+    segment_parts = int(config.get('tool', 'segment_parts'))
+    segment_min_size = int(config.get('tool', 'segment_min_size'))
+    adaptive_concurrency = str_to_bool(config.get('tool', 'adaptive_concurrency'))
+    concurrency_max = int(config.get('tool', 'concurrency_max'))
+    retry_attempts = int(config.get('tool', 'retry_attempts'))
+    retry_base_delay = float(config.get('tool', 'retry_base_delay'))
+    retry_max_delay = float(config.get('tool', 'retry_max_delay'))
+    host_requests_per_sec = float(config.get('tool', 'host_requests_per_sec'))
+    max_bytes_per_sec = int(config.get('tool', 'max_bytes_per_sec'))
     ingest_count = 0
     ingesting = False
-
     ### Initialize Logging
     log_file = strftime('stream_%Y%m%d_%H%M%S.log')
     log_path = config.get('tool', 'log_path')
@@ -513,11 +382,37 @@ if __name__ == "__main__":
     inputfile = ""
     argv = sys.argv[1:]
     try:
-        opts, args = getopt.getopt(argv,"hpdlfs:o:i:o:",["ifile="])
+        opts, args = getopt.getopt(argv,"hpdlfs:o:i:o:v:j:",["ifile="])
     except getopt.GetoptError:
         print_help()
         sys.exit(2)
 
+    # The database is created, or migrated from an older version, before any
+    # option reads it
+    db_check_exists(database)
+
+    # Job Selection
+    # Every option works on the job given with -j <name>, the default job
+    # without it. A job is created the first time it is named.
+    job_names = [default_job]
+    job_given = False
+    for opt, arg in opts:
+        if opt == '-j':
+            job_names = [arg]
+            job_given = True
+    try:
+        jobs = [db_get_job(database,name) for name in job_names]
+    except ValueError as e:
+        print();print(e);print()
+        sys.exit(2)
+    job = jobs[0]
+    # Each job downloads to its own folder under storage_path
+    job_storage = {}
+    for name, job_id in zip(job_names, jobs):
+        job_storage[job_id] = job_storage_path(storage_path, name)
+    storage_path = job_storage[job]
+    make_sure_path_exists(storage_path)
+
     for opt, arg in opts:
 
         # Help
@@ -527,21 +422,24 @@ if __name__ == "__main__":
 
         # Purge
         elif opt == '-p':
-            db_purge(database)
+            if job_given:
+                db_purge(database,job)
+            else:
+                db_purge(database)
             sys.exit()
 
         # Delete
         elif opt == '-d':
             # remove all Completed/Failed assets from database and NAS
-            inventory = db_get_inventory(database)
-            assets_completed = inventory[2]
-            assets_failed = inventory[3]
+            # The rows are read up front, they are deleted on the way
+            assets_completed = db_get_status(database,status_completed,job)
+            assets_failed = db_get_status(database,status_failed,job)
             if len(assets_completed) > 0:
                 print();print('There are ' + str(len(assets_completed)) + ' completed assets that will be deleted.')
                 for asset in assets_completed:
                     time.sleep(0.2)
-                    delete_asset_db(asset[0])
-                    filename = os.path.join(storage_path, asset[2].split('/')[-1])
+                    delete_asset_db(database,asset[0])
+                    filename = os.path.join(storage_path, asset[1])
                     deleted = delete_asset(filename)
                     if deleted == True:
                         print('Asset [' + str(asset[0]) + '] ' + filename + ' deleted.')
@@ -555,8 +453,13 @@ if __name__ == "__main__":
             if len(assets_failed) > 0:
                 print();print('There are ' + str(len(assets_failed)) + ' failed assets that will be deleted.')
                 for asset in assets_failed:
-                    delete_asset_db(asset[0])
-                    filename = os.path.join(storage_path, asset[2].split('/')[-1])
+                    delete_asset_db(database,asset[0])
+                    filename = os.path.join(storage_path, asset[1])
+                    # The range progress and version record of a partial download go with it
+                    ranges_discard(filename)
+                    validator_discard(filename)
+                    if not os.path.exists(filename):
+                        filename = part_filename(filename)
                     deleted = delete_asset(filename)    
                     if deleted == True:
                         print('Asset [' + str(asset[0]) + '] ' + filename + ' deleted.')
@@ -568,24 +471,27 @@ if __name__ == "__main__":
 
         # List
         elif opt == '-l':
+            print();print('Jobs:')
+            print_jobs(database)
+            print();print('Job = ' + job_names[0])
             inventory = db_get_inventory(database)
-            assets_new = inventory[0]
-            if len(assets_new) > 0:
-                print();print("New Assets = " + str(len(assets_new)))
-                print_assets(assets_new)
-            assets_queued = inventory[1]
-            if len(assets_queued) > 0:
-                print();print("Queued Assets = " + str(len(assets_queued)))
-                print_assets(assets_queued)
-            assets_completed = inventory[2]
-            if len(assets_completed) > 0:
-                print();print("Completed Assets = " + str(len(assets_completed)))
-                print_assets(assets_completed)
-            assets_failed = inventory[3]
-            if len(assets_failed) > 0:
-                print();print("Failed Assets = " + str(len(assets_failed)))
-                print_assets(assets_failed)
-            if (len(assets_new) == 0) and (len(assets_queued) == 0) and (len(assets_completed) == 0) and (len(assets_failed) == 0):
+            count_new = inventory[0]
+            if count_new > 0:
+                print();print("New Assets = " + str(count_new))
+                print_assets(db_iter_status(database,status_new,job))
+            count_queued = inventory[1]
+            if count_queued > 0:
+                print();print("Queued Assets = " + str(count_queued))
+                print_assets(db_iter_status(database,status_queued,job))
+            count_completed = inventory[2]
+            if count_completed > 0:
+                print();print("Completed Assets = " + str(count_completed))
+                print_assets(db_iter_status(database,status_completed,job))
+            count_failed = inventory[3]
+            if count_failed > 0:
+                print();print("Failed Assets = " + str(count_failed))
+                print_assets(db_iter_status(database,status_failed,job))
+            if (count_new == 0) and (count_queued == 0) and (count_completed == 0) and (count_failed == 0):
                 print();print("The database contains no assets.")
             get_inventory_print(database)
             print();sys.exit()
@@ -595,24 +501,46 @@ if __name__ == "__main__":
             output_file = arg
             counter = 1
             if output_file:
-                inventory = db_get_inventory(database)
-                assets_completed = inventory[2]
-                out_data = b''
-                for asset in assets_completed:
-                    with open(storage_path + asset[1], 'rb') as fp:
-                        print('[' + str(counter) + '] ' + asset[1])
-                        out_data += fp.read()
-                    counter += 1    
-                fp.close()
-                print();print("Combining all *.ts files into single stream file " + output_file + "...")
-                with open(output_file, 'wb') as fp:
-                    fp.write(out_data)
-                fp.close()
+                # Databases from older versions get the sequence columns first
+                db_check_exists(database)
+                # Segments missing from the middle of the stream would be skipped
+                gaps = db_sequence_gaps(database,status_completed,job)
+                if len(gaps) > 0:
+                    print();print("Warning: segments " + gaps_msg(gaps) + " are not downloaded and will be missing from " + output_file + ".")
+                print();print("Combining all *.ts files into single stream file " + output_file + "...");print()
+                # Segments are streamed into the output file in playlist order, nothing is held in memory
+                combiner = Combiner(output_file)
+                for asset in db_iter_status(database,status_completed,job):
+                    print('[' + str(counter) + '] ' + asset[1])
+                    combiner.append(storage_path + asset[1])
+                    counter += 1
+                combiner.close()
+                print();print(combiner.summary())
                 print();print('Done.')
             else:
                 print();print("Stream filename not specified.")
             print();sys.exit()
 
+        # Serve video files as a single stream file over local HTTP
+        elif opt == '-v':
+            port = int(arg)
+            db_check_exists(database)
+            gaps = db_sequence_gaps(database,status_completed,job)
+            if len(gaps) > 0:
+                print();print("Warning: segments " + gaps_msg(gaps) + " are not downloaded and will be missing from the stream.")
+            completed = db_get_status(database,status_completed,job)
+            filenames = [storage_path + asset[1] for asset in completed]
+            durations = [asset[11] for asset in completed]
+            if len(filenames) > 0:
+                stream = VirtualStream(filenames)
+                write_playlist('playback.m3u8', filenames, durations)
+                print();print(stream.summary() + ', playlist written to playback.m3u8')
+                print('Serving http://127.0.0.1:' + str(port) + stream_path + ' (Ctrl-C to stop)...')
+                serve_stream(stream, port, debug)
+            else:
+                print();print("There are no completed assets to serve.")
+            print();sys.exit()
+
         # Import assets list file or .m3u8 playlist
         # All media assets in the .m3u8 playlist must provide the full url
         elif opt in ("-i", "--ifile"):
@@ -643,20 +571,11 @@ if __name__ == "__main__":
     #     urllib.request.urlretrieve(url, filename)
     #     q.put(filename)
 
-    status_new = 0
-    status_queued = 1
-    status_failed = 6
-    status_completed = 7
-
     ### Get the latest asset statuses
     if db_check_exists(database):
         inventory = db_get_inventory_log(database)
-        assets_new = inventory[0]
-        assets_queued = inventory[1]
-        assets_completed = inventory[2]
-        assets_failed = inventory[3]
         # Total number of assets for the download queue
-        assets_total = len(assets_new) + len(assets_queued) + len(assets_failed)
+        assets_total = inventory[0] + inventory[1] + inventory[3]
 
     # Exit if no assets available or ingest completed
     if assets_total > 0:
@@ -665,14 +584,14 @@ if __name__ == "__main__":
         # Prepare the queue
         q = Queue()
         # Assets fresh in the database
-        for asset in assets_new:
-            q.put(asset[2])
+        for asset in db_iter_status(database,status_new,job):
+            q.put((asset[0], asset[1], asset[2]))
         # Assets that were previously queued
-        for asset in assets_queued:
-            q.put(asset[2])
+        for asset in db_iter_status(database,status_queued,job):
+            q.put((asset[0], asset[1], asset[2]))
         # Assets that failed to download previously
-        for asset in assets_failed:
-            q.put(asset[2])
+        for asset in db_iter_status(database,status_failed,job):
+            q.put((asset[0], asset[1], asset[2]))
     else:
         ingesting = False
         log.info('There are no assets ready to download, or script has completed. Exiting...')
@@ -681,13 +600,71 @@ if __name__ == "__main__":
 
     num_cores = min(q.qsize(),cpu_count())
 
+    # Start with one download per core, then let the controller adapt the
+    # number of downloads in flight to the network
+    if adaptive_concurrency:
+        controller = AimdController(num_cores, maximum=concurrency_max)
+        num_workers = max(num_cores, min(q.qsize(), concurrency_max))
+    else:
+        controller = None
+        num_workers = num_cores
+
+    # Request rate and bandwidth limits, shared with every worker process
+    limiter = RateLimiter(host_requests_per_sec, max_bytes_per_sec)
+    if limiter.enabled():
+        set_limiter(limiter)
+        log.info(limiter.summary())
+    else:
+        limiter = None
+
+    # Stalled transfers are aborted and retried
+    set_stall_limits(stall_min_speed, http_timeout)
+
+    # Failed downloads are retried by the worker after a backoff
+    retry = RetryPolicy(retry_attempts, retry_base_delay, retry_max_delay)
+    log.info(retry.summary())
+
+    # The workers send their state changes to one writer process
+    writer = DbWriter(database)
+    writer.start()
+
     # Start the download timer
     stream_start_time = time.time()
 
-    with concurrent.futures.ProcessPoolExecutor(num_cores) as executor:
-        while not q.empty():
-            url = q.get()
-            executor.submit(download_target, url, assets_total)
+    # Each worker process has its own connection pool, add up what they reported
+    transfers = 0
+    reused = 0
+    retries = 0
+    failed = 0
+    stall_count = 0
+    with concurrent.futures.ProcessPoolExecutor(num_workers, initializer=init_worker, initargs=(limiter, writer.queue)) as executor:
+        running = set()
+        while not q.empty() or running:
+            if controller is not None:
+                limit = controller.limit
+            else:
+                limit = num_workers
+            while not q.empty() and len(running) < limit:
+                aid, filename, url = q.get()
+                running.add(executor.submit(download_target, aid, filename, url, assets_total))
+            done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                downloaded, asset_transfers, asset_reused, size, error, attempts, stalls = future.result()
+                transfers += asset_transfers
+                reused += asset_reused
+                retries += attempts - 1
+                stall_count += stalls
+                if downloaded:
+                    ingest_count += 1
+                else:
+                    failed += 1
+                if controller is not None:
+                    if downloaded:
+                        controller.record(size)
+                    else:
+                        controller.record(http_code=error_http_code(error), failed=True)
+
+    writer.close()
 
     while not q.empty():
         print(q.get())
@@ -826,6 +803,13 @@ if __name__ == "__main__":
 
     duration = str(day)+' '+dtxt+' '+str(hour)+' '+htxt+' '+str(mins)+' '+mtxt+' '+str(secs)+' '+stxt
     log.info('Assets Downloaded = ' + str(ingest_count))
+    log.info(reuse_summary([transfers, reused]))
+    log.info(retry_summary(retries, failed))
+    log.info(stall_summary(stall_count))
+    log.info(writer.summary())
+    if controller is not None:
+        log.info(controller.summary())
+    close_db()
     log.info('--------------------------------')
     log.info('Completed')
     log.info('Runtime = ' + str(day)+"d:"+str(hour)+"h:"+str(mins)+"m:"+str(secs)+"s, " + duration)
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: Hedged requests for slow segments. A few stuck segments decide
+#  when a whole download finishes, so when a transfer is still waiting for
+#  its first byte well past the usual time-to-first-byte (the 95th
+#  percentile of recent transfers) the engine sends the same request again
+#  on another connection and keeps whichever copy finishes first.
+#  The budget caps the extra requests at a share of all transfers started.
+# -----------------------------------------------------------------------------
+#
+### Packages
+from collections import deque
+
+#-----------------------------------------------------------------------#
+# Hedge Tracker
+#-----------------------------------------------------------------------#
+
+class HedgeTracker:
+
+	def __init__(self, budget=0.05, percentile=95, samples=200, min_samples=20, min_delay=0.25):
+		self.budget = float(budget)
+		self.percentile = percentile
+		self.min_samples = min_samples
+		# Never hedge sooner than this, fast networks have tiny TTFBs
+		self.min_delay = min_delay
+		self.ttfbs = deque(maxlen=samples)
+		self.started = 0
+		self.hedged = 0
+		self.won = 0
+
+	# Time to first byte of a finished transfer
+	def record(self, ttfb):
+		if ttfb:
+			self.ttfbs.append(ttfb)
+
+	# A transfer was started (hedges not included)
+	def start(self):
+		self.started += 1
+
+	# Seconds without a first byte after which a transfer is hedged, None
+	# until enough transfers have finished to know what is normal
+	def threshold(self):
+		if self.budget <= 0 or len(self.ttfbs) < self.min_samples:
+			return None
+		ttfbs = sorted(self.ttfbs)
+		index = min(len(ttfbs) - 1, int(len(ttfbs) * self.percentile / 100))
+		return max(self.min_delay, ttfbs[index])
+
+	# Whether another hedge fits in the budget, and count it if so
+	def allow(self):
+		if self.hedged + 1 > self.budget * self.started:
+			return False
+		self.hedged += 1
+		return True
+
+	# The hedge finished before the original request
+	def hedge_won(self):
+		self.won += 1
+
+	def summary(self):
+		return 'Hedged Requests = ' + str(self.hedged) + '/' + str(self.started) + ' transfers, ' + str(self.won) + ' won (budget ' + str(int(self.budget * 100)) + '%)'
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: Token bucket rate limits shared by every download worker.
+#  Requests per second are limited per host, bytes per second for all
+#  downloads together. The buckets live in shared memory behind one lock,
+#  so the worker processes of rumble.py/gpt.py and the in-process download
+#  engines of stream.py draw from the same buckets.
+#  A bucket may go into debt; the caller waits until it is paid back, which
+#  gives a steady rate instead of bursts followed by throttling.
+# -----------------------------------------------------------------------------
+#
+### Packages
+import time
+import zlib
+import multiprocessing
+
+#-----------------------------------------------------------------------#
+# Rate Limiter
+#-----------------------------------------------------------------------#
+
+class RateLimiter:
+
+	# Hosts are hashed into this many buckets, hosts that collide share one
+	host_slots = 64
+
+	def __init__(self, requests_per_host=0, bytes_per_sec=0):
+		self.requests_per_host = float(requests_per_host)
+		self.bytes_per_sec = float(bytes_per_sec)
+		self.lock = multiprocessing.Lock()
+		# [tokens, last refill time] per bucket
+		self.hosts = multiprocessing.RawArray('d', self.host_slots * 2)
+		self.bandwidth = multiprocessing.RawArray('d', 2)
+
+	# Take 'amount' tokens from a bucket, returns the seconds to wait before
+	# the tokens are actually available
+	def reserve(self, bucket, index, rate, amount):
+		burst = max(1.0, rate)
+		with self.lock:
+			now = time.monotonic()
+			last = bucket[index + 1]
+			if last == 0:
+				tokens = burst
+			else:
+				tokens = min(burst, bucket[index] + (now - last) * rate)
+			tokens -= amount
+			bucket[index] = tokens
+			bucket[index + 1] = now
+		if tokens >= 0:
+			return 0
+		return -tokens / rate
+
+	# Seconds to wait before sending the next request to 'hostname'
+	def request_delay(self, hostname):
+		if self.requests_per_host <= 0:
+			return 0
+		slot = zlib.crc32(hostname.encode()) % self.host_slots
+		return self.reserve(self.hosts, slot * 2, self.requests_per_host, 1)
+
+	# Seconds to wait after receiving 'size' bytes
+	def bytes_delay(self, size):
+		if self.bytes_per_sec <= 0:
+			return 0
+		return self.reserve(self.bandwidth, 0, self.bytes_per_sec, size)
+
+	def enabled(self):
+		return self.requests_per_host > 0 or self.bytes_per_sec > 0
+
+	def summary(self):
+		msg = 'Rate Limits = '
+		if self.requests_per_host > 0:
+			msg += str(self.requests_per_host) + ' requests/sec per host'
+		else:
+			msg += 'no request limit'
+		if self.bytes_per_sec > 0:
+			msg += ', ' + str(int(self.bytes_per_sec)) + ' bytes/sec total'
+		else:
+			msg += ', no bandwidth limit'
+		return msg
+
+#-----------------------------------------------------------------------#
+# Process-wide limiter
+#-----------------------------------------------------------------------#
+
+limiter = None
+
+# Install the limiter for this process. Also used as the initializer of
+# worker processes so that every worker shares the parent's buckets.
+def set_limiter(rate_limiter):
+	global limiter
+	limiter = rate_limiter
+
+def get_limiter():
+	return limiter
+
+# Wait until a request to 'hostname' is allowed
+def wait_request(hostname):
+	if limiter is not None:
+		delay = limiter.request_delay(hostname)
+		if delay > 0:
+			time.sleep(delay)
+
+# Write callback that keeps the total download rate under the bandwidth cap
+# by holding the transfer back after each block of data. It sleeps, so it is
+# only for blocking transfers that have the thread to themselves.
+def throttled_writer(write):
+	if limiter is None or limiter.bytes_per_sec <= 0:
+		return write
+	rate_limiter = limiter
+	def throttled(data):
+		result = write(data)
+		delay = rate_limiter.bytes_delay(len(data))
+		if delay > 0:
+			time.sleep(delay)
+		return result
+	return throttled
+
+# Write callback for transfers that share a thread, such as the ones of a
+# CurlMulti, where a sleep would hold back every transfer at once. Instead of
+# sleeping it calls 'hold(delay)', which holds back only this transfer.
+def paced_writer(write, hold):
+	if limiter is None or limiter.bytes_per_sec <= 0:
+		return write
+	rate_limiter = limiter
+	def paced(data):
+		result = write(data)
+		delay = rate_limiter.bytes_delay(len(data))
+		if delay > 0:
+			hold(delay)
+		return result
+	return paced
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: Retry policy for failed downloads. A failed transfer is tried
+#  again after an exponential backoff with full jitter (a random wait
+#  between 0 and base * 2^attempt, capped), so retries of many assets
+#  spread out instead of arriving at a struggling CDN edge all at once.
+#  Only transient failures are retried: timeouts, dropped connections, 5xx
+#  and 408/429 replies. A 404/410 or a local error fails the asset at once.
+# -----------------------------------------------------------------------------
+#
+### Packages
+import random
+# Third-Party
+import pycurl
+
+#-----------------------------------------------------------------------#
+# Functions
+#-----------------------------------------------------------------------#
+
+# HTTP replies worth another try, every other 4xx is permanent
+retry_codes = (408, 425, 429)
+
+# curl errors that won't go away by trying again
+permanent_errors = (
+	pycurl.E_UNSUPPORTED_PROTOCOL,
+	pycurl.E_URL_MALFORMAT,
+	pycurl.E_WRITE_ERROR,
+	pycurl.E_FILESIZE_EXCEEDED,
+	pycurl.E_LOGIN_DENIED,
+	pycurl.E_REMOTE_FILE_NOT_FOUND,
+	pycurl.E_SSL_CACERT,
+)
+
+# Whether a failure is worth another attempt. 'http_code' is the HTTP
+# status of the reply (0 if there was none), 'errno' the curl error code
+# (0 if the failure didn't come from curl).
+def retryable(http_code=0, errno=0):
+	if http_code >= 500 or http_code in retry_codes:
+		return True
+	if http_code >= 400:
+		return False
+	return errno not in permanent_errors
+
+#-----------------------------------------------------------------------#
+# Retry Policy
+#-----------------------------------------------------------------------#
+
+class RetryPolicy:
+
+	def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0):
+		self.max_attempts = max(1, int(max_attempts))
+		self.base_delay = float(base_delay)
+		self.max_delay = float(max_delay)
+
+	# Wait before the next attempt, full jitter
+	def backoff(self, attempts):
+		return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempts - 1)))
+
+	# Seconds to wait after the failed attempt number 'attempts', or None
+	# when the asset has failed for good
+	def next_delay(self, attempts, http_code=0, errno=0):
+		if attempts >= self.max_attempts or not retryable(http_code, errno):
+			return None
+		return self.backoff(attempts)
+
+	def summary(self):
+		return 'Retry Policy = ' + str(self.max_attempts) + ' attempts, backoff ' + str(self.base_delay) + '-' + str(self.max_delay) + ' sec'
+
+# Summary line of the retries made in a run
+def retry_summary(retries, failed):
+	return 'Retries = ' + str(retries) + ', failed for good = ' + str(failed)
@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: In-process download scheduler for stream.py. Queued assets are
+#  claimed from the database in batches and kept in memory by asset id, and
+#  every state change (completed, failed) is recorded as an event that is
+#  written to SQLite in batches, one transaction per batch. The work per
+#  segment stays the same however large the job is, nothing re-reads the
+#  whole inventory. Events not yet written when the script is stopped are
+#  recovered on the next run: downloaded files are found on disk and
+#  partial files resume.
+#  A claim leases the assets to this process (owner host:pid) for a while
+#  and the download transport renews the lease through keep() while it
+#  runs, so several stream.py processes can share one job without
+#  downloading an asset twice. The assets of a process that died are
+#  claimed again once its lease expires. A transfer whose lease could not
+#  be renewed in time is stopped, the asset belongs to its new owner.
+#  One scheduler can run several jobs at once, their assets share the
+#  download transport and its connections.
+# -----------------------------------------------------------------------------
+#
+### Packages
+import os
+import time
+import socket
+import sqlite3
+# Database
+from db import db_move_status, db_apply_transitions, db_claim, db_renew_leases, db_release, metric_values
+
+#-----------------------------------------------------------------------#
+# Scheduler
+#-----------------------------------------------------------------------#
+
+class Scheduler:
+
+	def __init__(self, database, jobs, queued, active, lease=300, batch_size=500, flush_interval=1.0):
+		self.database = database
+		# Ids of the jobs whose assets are claimed
+		self.jobs = jobs
+		# Statuses of assets waiting for a process and claimed by one
+		self.status_queued = queued
+		self.status_active = active
+		# Seconds a claim lasts without being renewed
+		self.lease = lease
+		self.owner = socket.gethostname() + ':' + str(os.getpid())
+		self.last_renew = time.monotonic()
+		# Events written per transaction, and the longest an event waits
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		# Claimed assets not finished yet by id, in playlist order
+		self.queued = {}
+		self.claimed = 0
+		# Claimed assets whose lease was lost to another process
+		self.lost = 0
+		# (status, attempts, last error, asset id) not written yet, and the
+		# transfer details of the downloads among them
+		self.events = []
+		self.metrics = []
+		self.last_flush = time.monotonic()
+		self.written = 0
+		self.flushes = 0
+
+	# Move every asset in one of 'statuses' to 'status' at once, returns the count
+	def move(self, statuses, status):
+		return db_move_status(self.database, statuses, status, self.jobs)
+
+	# Claim up to 'count' more queued assets, returns them in playlist order
+	def claim(self, count):
+		# Events of earlier claims go out first, they end those leases
+		self.flush()
+		# The lease of earlier claims is not extended by this one
+		if not self.queued:
+			self.last_renew = time.monotonic()
+		assets = db_claim(self.database, self.owner, count, self.lease, self.status_queued, self.status_active, self.jobs)
+		for asset in assets:
+			self.queued[asset[0]] = asset
+		self.claimed += len(assets)
+		return assets
+
+	# The asset moved to 'status', 'attempts' download attempts are added to it.
+	# 'info' are the transfer details of a completed download. An asset whose
+	# lease was lost belongs to another process, its state is left alone.
+	def transition(self, aid, status, attempts=0, last_error=None, info=None):
+		if self.queued.pop(aid, None) is None:
+			return
+		self.events.append((status, attempts, last_error, aid))
+		if info is not None:
+			self.metrics.append(metric_values(info) + (aid,))
+		if len(self.events) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+			self.flush()
+
+	# Write the recorded events in one transaction
+	def flush(self):
+		if len(self.events) > 0:
+			db_apply_transitions(self.database, self.events, self.metrics)
+			self.written += len(self.events)
+			self.flushes += 1
+			self.events = []
+			self.metrics = []
+		self.last_flush = time.monotonic()
+
+	# Called by the download transport at least once a second while it runs.
+	# Renews the leases well before they run out, and writes events that
+	# waited longer than flush_interval. Returns the claimed assets this
+	# process no longer holds, their transfers must stop.
+	def keep(self):
+		now = time.monotonic()
+		if self.events and now - self.last_flush >= self.flush_interval:
+			try:
+				self.flush()
+			except sqlite3.OperationalError:
+				pass
+		if not self.queued or now - self.last_renew < self.lease / 3:
+			return []
+		try:
+			held = db_renew_leases(self.database, self.owner, self.lease, self.status_active, self.jobs)
+		except sqlite3.OperationalError:
+			# The database stayed locked past the busy timeout, try again
+			# on the next call while the lease lasts
+			if now - self.last_renew < self.lease:
+				return []
+			held = set()
+		self.last_renew = now
+		lost = []
+		for aid in list(self.queued):
+			if aid not in held:
+				lost.append(self.queued.pop(aid))
+		self.lost += len(lost)
+		return lost
+
+	# Monotonic time until which every claimed asset surely is leased to this
+	# process. The time of a renewal is taken before the database is asked,
+	# so the leases in the database run out a little later than this.
+	def deadline(self):
+		return self.last_renew + self.lease
+
+	# Write what is left and give back the assets claimed but not finished
+	def close(self):
+		self.flush()
+		self.queued = {}
+		return db_release(self.database, self.owner, self.status_queued, self.status_active, self.jobs)
+
+	def summary(self):
+		msg = 'State Changes = ' + str(self.written) + ' written in ' + str(self.flushes) + ' transactions, ' + str(self.claimed) + ' assets claimed as ' + self.owner
+		if self.lost > 0:
+			msg += ', ' + str(self.lost) + ' leases lost'
+		return msg
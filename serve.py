@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: Serve the downloaded segments as one virtual stream file (-v).
+#  Instead of writing a combined copy of the archive, an index of where each
+#  segment starts in the stream is built from the file sizes and a local
+#  HTTP server answers Range requests by sending the matching parts of the
+#  segment files. Players and HandBrakeCLI read the archive from
+#  http://127.0.0.1:<port>/stream.ts with nothing copied on disk.
+# -----------------------------------------------------------------------------
+#
+### Packages
+import os
+import re
+import math
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# URL path of the virtual stream file
+stream_path = '/stream.ts'
+
+# Seconds listed in playback.m3u8 for segments of unknown duration
+default_duration = 10.0
+
+#-----------------------------------------------------------------------#
+# Virtual Stream
+#-----------------------------------------------------------------------#
+
+# The segment files in stream order, read as one file
+class VirtualStream:
+
+	def __init__(self, filenames):
+		self.filenames = []
+		# Byte offset in the stream where each segment starts
+		self.offsets = []
+		self.size = 0
+		for filename in filenames:
+			size = os.path.getsize(filename)
+			if size == 0:
+				continue
+			self.filenames.append(filename)
+			self.offsets.append(self.size)
+			self.size += size
+
+	# The segment parts holding stream bytes 'start' to 'end' (inclusive),
+	# as (filename, offset in the file, byte count)
+	def pieces(self, start, end):
+		index = bisect.bisect_right(self.offsets, start) - 1
+		while start <= end and index < len(self.filenames):
+			offset = start - self.offsets[index]
+			if index + 1 < len(self.offsets):
+				segment_end = self.offsets[index + 1] - 1
+			else:
+				segment_end = self.size - 1
+			count = min(end, segment_end) - start + 1
+			yield (self.filenames[index], offset, count)
+			start += count
+			index += 1
+
+	def summary(self):
+		return 'Virtual stream = ' + str(len(self.filenames)) + ' segments, ' + str(self.size) + ' bytes'
+
+# Byte range asked for by a Range header as (start, end), None for the whole
+# file. Raises ValueError when no part of the range is in the file.
+def parse_range(header, size):
+	m = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', header or '')
+	# Missing, malformed or multiple ranges, send the whole file
+	if not m or (m.group(1) == '' and m.group(2) == ''):
+		return None
+	if m.group(1) == '':
+		# Suffix range, the last N bytes
+		length = int(m.group(2))
+		if length == 0:
+			raise ValueError('empty suffix range')
+		return (max(0, size - length), size - 1)
+	start = int(m.group(1))
+	end = size - 1
+	if m.group(2) != '':
+		end = min(end, int(m.group(2)))
+	if start >= size or start > end:
+		raise ValueError('range not satisfiable')
+	return (start, end)
+
+#-----------------------------------------------------------------------#
+# HTTP Server
+#-----------------------------------------------------------------------#
+
+class StreamHandler(BaseHTTPRequestHandler):
+
+	def do_HEAD(self):
+		self.send_stream(False)
+
+	def do_GET(self):
+		self.send_stream(True)
+
+	def send_stream(self, body):
+		stream = self.server.stream
+		if self.path.split('?')[0] not in ('/', stream_path):
+			self.send_error(404)
+			return
+		try:
+			byte_range = parse_range(self.headers.get('Range'), stream.size)
+		except ValueError:
+			self.send_response(416)
+			self.send_header('Content-Range', 'bytes */' + str(stream.size))
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+		if byte_range is None:
+			start, end = 0, stream.size - 1
+			self.send_response(200)
+		else:
+			start, end = byte_range
+			self.send_response(206)
+			self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(end) + '/' + str(stream.size))
+		self.send_header('Content-Type', 'video/mp2t')
+		self.send_header('Accept-Ranges', 'bytes')
+		self.send_header('Content-Length', str(end - start + 1))
+		self.end_headers()
+		if not body or end < start:
+			return
+		self.wfile.flush()
+		try:
+			# socket.sendfile hands the copy to the kernel where it can
+			for filename, offset, count in stream.pieces(start, end):
+				with open(filename, 'rb') as f:
+					self.connection.sendfile(f, offset, count)
+		except (BrokenPipeError, ConnectionResetError):
+			# Players drop connections all the time when seeking
+			self.close_connection = True
+
+	def log_message(self, format, *args):
+		if self.server.debug:
+			BaseHTTPRequestHandler.log_message(self, format, *args)
+
+# Serve the stream on 127.0.0.1 until interrupted
+def serve_stream(stream, port, debug=False):
+	server = ThreadingHTTPServer(('127.0.0.1', port), StreamHandler)
+	server.daemon_threads = True
+	server.stream = stream
+	server.debug = debug
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+# HLS VOD playlist of the local segment files, for players and HandBrakeCLI
+# that read m3u8 playlists. 'durations' are the seconds of each segment from
+# the imported playlist; a segment imported from a plain list of urls has
+# none (0) and is listed with the longest known duration, or default_duration.
+def write_playlist(playlist_file, filenames, durations):
+	known = [duration for duration in durations if duration > 0]
+	fallback = max(known) if known else default_duration
+	durations = [duration if duration > 0 else fallback for duration in durations]
+	with open(playlist_file, 'w') as f:
+		f.write('#EXTM3U\n')
+		f.write('#EXT-X-VERSION:3\n')
+		f.write('#EXT-X-PLAYLIST-TYPE:VOD\n')
+		# The duration of every segment, rounded, must not exceed the target
+		f.write('#EXT-X-TARGETDURATION:' + str(int(math.ceil(max(durations, default=fallback)))) + '\n')
+		f.write('#EXT-X-MEDIA-SEQUENCE:0\n')
+		for filename, duration in zip(filenames, durations):
+			f.write('#EXTINF:' + '%0.3f' % duration + ',\n')
+			f.write(filename + '\n')
+		f.write('#EXT-X-ENDLIST\n')
@@ -22,9 +22,30 @@ import logging.handlers
 # Configuration
 import configparser
 # Third-Party
-import sqlite3
 import getopt
 import pycurl
+# Download Engine
+from curl_pool import close_pool, reuse_summary, set_stall_limits, stall_summary
+from downloader import part_filename, resume_offset, validator_discard
+from transport import get_transport
+from concurrency import AimdController, rate_msg
+from ratelimit import RateLimiter, set_limiter
+# Retries
+from retry import RetryPolicy, retry_summary
+# Stream Combine
+from combine import Combiner, OrderedCombiner
+# Virtual Stream
+from serve import VirtualStream, serve_stream, write_playlist, stream_path
+# Playlist Import
+from importer import import_playlist, import_summary
+# Database
+from db import close_db, db_check_exists, db_get_job, db_list_jobs, db_edge_metrics, default_job, job_storage_path, db_purge, db_status_counts, db_get_status, db_iter_status, db_get_assets, db_sequence_gaps, gaps_msg, delete_asset_db
+# Ingest Status, the same in every script
+from db import status_new, status_queued, status_active, status_completed, status_failed
+# Hedged Requests
+from hedge import HedgeTracker
+# Download Scheduler
+from scheduler import Scheduler
 
 def str_to_bool(s):
 	if s == "True":
@@ -43,6 +64,18 @@ database = config.get('tool', 'database')
 queue_limit = int(config.get('tool', 'queue_limit'))
 storage_path = config.get('tool', 'storage_path')
 http_timeout = int(config.get('tool', 'http_timeout'))
+stall_min_speed = int(config.get('tool', 'stall_min_speed'))
+host_requests_per_sec = float(config.get('tool', 'host_requests_per_sec'))
+max_bytes_per_sec = int(config.get('tool', 'max_bytes_per_sec'))
+transport = config.get('tool', 'transport')
+adaptive_concurrency = str_to_bool(config.get('tool', 'adaptive_concurrency'))
+concurrency_max = int(config.get('tool', 'concurrency_max'))
+retry_attempts = int(config.get('tool', 'retry_attempts'))
+retry_base_delay = float(config.get('tool', 'retry_base_delay'))
+retry_max_delay = float(config.get('tool', 'retry_max_delay'))
+hedge_budget = float(config.get('tool', 'hedge_budget'))
+claim_size = int(config.get('tool', 'claim_size'))
+lease_time = int(config.get('tool', 'lease_time'))
 
 ingest_count = 0
 ingesting = False
@@ -70,13 +103,6 @@ def delete_asset(path):
 		return False
 	return True
 
-def delete_asset_db(asset):
-	conn = sqlite3.connect(database)
-	c = conn.cursor()
-	c.execute("DELETE FROM assets WHERE id=?", (int(asset),))
-	conn.commit()
-	conn.close()
-
 def duration_msg(duration,message):
 	duration = round(duration,3)
 	if duration < 1:
@@ -146,88 +172,25 @@ def csv_asset_failed(pid_aid,csvfile,error):
 		f.write(pid_aid + ',' + error +'\n')
 	f.close()
 
-# create the database if not present
-def db_check_exists(database):
-	sql = """ CREATE TABLE "assets" (
-		id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-		asset TEXT NOT NULL DEFAULT "",
-		asset_uri TEXT NOT NULL DEFAULT "",
-		status INTEGER NOT NULL DEFAULT 0
-	); """
-	exists = os.path.isfile(database)
-	if exists:
-		#print('Database ' + database + ' already created.')
-		return True
-	else:
-		print();print('Database ' + database + ' missing, creating new database.')
-		conn = sqlite3.connect(database)
-		c = conn.cursor()
-		c.execute(sql)
-		conn.commit()
-		conn.close()
-		print();print('Database ' + database + ' created.')
-		return True
+# Local file name of an asset url
+def asset_name(asset_uri):
+	return asset_uri.split('/')[-1]
 
 def db_asset_importer(database,inputfile):
-	asset_count = 0
-	conn = sqlite3.connect(database)
-	c = conn.cursor()
-	#log.info('Asset file: ' + inputfile)
-	f=open(inputfile,'r')
-	for line in f.readlines():
-		if (not line in ['\n','\r\n']):
-			if line.startswith('http') or line.startswith('https'):
-				asset = (line.split('/')[-1]).strip();print("[" + str(asset_count+1) + "] " + asset)
-				asset_uri = line.strip();print(asset_uri)
-				c.execute("INSERT INTO assets (asset,asset_uri) \
-					VALUES (?,?)", (asset,asset_uri))
-				asset_count+=1
-	f.close()
-	conn.commit()
-	conn.close()
-	print();print('There were '+str(asset_count)+' assets imported from file ' + inputfile + '.');print()
+	inserted, skipped, duration = import_playlist(database, inputfile, asset_name, job)
+	print();print(import_summary(inserted, skipped, duration, inputfile));print()
 
 
 def get_inventory_print(database):
+	inventory = db_get_inventory(database)
 	print('--------------------------------')
 	print('Assets Database:')
-
-	assets_new = []
-	assets_queued = []
-	assets_active = []
-	assets_completed = []
-	assets_failed = []
-
-	conn = sqlite3.connect(database)
-	# New
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=0")
-	assets_new = c.fetchall()
-	print('New       = ' + str(len(assets_new)))
-	# Queued
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=1")
-	assets_queued = c.fetchall()
-	print('Queued    = ' + str(len(assets_queued)))
-	# Active
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=2")
-	assets_active = c.fetchall()
-	print('Active    = ' + str(len(assets_active)))
-	# Completed
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=3")
-	assets_completed = c.fetchall()
-	print('Completed = ' + str(len(assets_completed)))
-	# Failed
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=5")
-	assets_failed = c.fetchall()
-	print('Failed    = ' + str(len(assets_failed)))
-
-	conn.close()
+	print('New       = ' + str(inventory[0]))
+	print('Queued    = ' + str(inventory[1]))
+	print('Active    = ' + str(inventory[2]))
+	print('Completed = ' + str(inventory[3]))
+	print('Failed    = ' + str(inventory[4]))
 	print('--------------------------------')
-#	return [assets_new, assets_queued, assets_active, assets_completed, assets_failed]
 
 
 def delete_asset(path):
@@ -242,13 +205,6 @@ def delete_asset(path):
 		return False
 	return True
 
-def delete_asset_db(asset):
-	conn = sqlite3.connect(database)
-	c = conn.cursor()
-	c.execute("DELETE FROM assets WHERE id=?", (int(asset),))
-	conn.commit()
-	conn.close()
-
 def duration_msg(duration,message):
 	duration = round(duration,3)
 	if duration < 1:
@@ -310,174 +266,77 @@ def file_check_exists(inputfile):
 
 
 def db_get_inventory_log(database):
+	inventory = db_get_inventory(database)
 	log.info('--------------------------------')
 	log.info('Assets Database:')
-
-	assets_new = []
-	assets_queued = []
-	assets_active = []
-	assets_completed = []
-	assets_failed = []
-
-	conn = sqlite3.connect(database)
-	# New
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=0")
-	assets_new = c.fetchall()
-	log.info('New       = ' + str(len(assets_new)))
-	# Queued
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=1")
-	assets_queued = c.fetchall()
-	log.info('Queued    = ' + str(len(assets_queued)))
-	# Active
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=2")
-	assets_active = c.fetchall()
-	log.info('Active    = ' + str(len(assets_active)))
-	# Completed
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=3")
-	assets_completed = c.fetchall()
-	log.info('Completed = ' + str(len(assets_completed)))
-	# Failed
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=5")
-	assets_failed = c.fetchall()
-	log.info('Failed    = ' + str(len(assets_failed)))
-
-	conn.close()
+	log.info('New       = ' + str(inventory[0]))
+	log.info('Queued    = ' + str(inventory[1]))
+	log.info('Active    = ' + str(inventory[2]))
+	log.info('Completed = ' + str(inventory[3]))
+	log.info('Failed    = ' + str(inventory[4]))
 	log.info('--------------------------------')
-	return [assets_new, assets_queued, assets_active, assets_completed, assets_failed]
+	return inventory
 
 
+# Number of assets in each status, [New, Queued, Active, Completed, Failed]
 def db_get_inventory(database):
-	assets_new = []
-	assets_queued = []
-	assets_active = []
-	assets_completed = []
-	assets_failed = []
-
-	conn = sqlite3.connect(database)
-	# New
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=0")
-	assets_new = c.fetchall()
-	# Queued
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=1")
-	assets_queued = c.fetchall()
-	# Active
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=2")
-	assets_active = c.fetchall()
-	# Completed
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=3")
-	assets_completed = c.fetchall()
-	# Failed
-	c = conn.cursor()
-	c.execute("SELECT * FROM assets WHERE status=5")
-	assets_failed = c.fetchall()
-
-	conn.close()
-	return [assets_new, assets_queued, assets_active, assets_completed, assets_failed]
-
-
-def db_update_asset_status(database,aid,status):
-	conn = sqlite3.connect(database)
-	c = conn.cursor()
-	c.execute("UPDATE assets SET status=? WHERE id=?", (status,aid))
-	conn.commit()
-	conn.close()
-
-def db_update_asset_status_asset(database,asset,status):
-	conn = sqlite3.connect(database)
-	c = conn.cursor()
-	c.execute("UPDATE assets SET status=? WHERE asset=?", (status,asset))
-	conn.commit()
-	conn.close()
-
-def db_purge(database):
-	sql = """ CREATE TABLE "assets" (
-		id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-		asset TEXT NOT NULL DEFAULT "",
-		asset_uri TEXT NOT NULL DEFAULT "",
-		status INTEGER NOT NULL DEFAULT 0
-	); """
-	conn = sqlite3.connect(database)
-	c = conn.cursor()
-	c.execute("DROP TABLE assets")
-	c.execute(sql)
-	conn.commit()
-	conn.close()
-	print();print('Database ' + database + ' purged.');print()
-
-
-# Download asset from target
-def download_target(url,ingest_count,assets_total):
-	hostname = url.split('/')[2]
-
-	headers = [
-		'Accept:application/octet-stream',
-		'Connection:keep-alive',
-		'Content-Type:application/gzip',
-		'Host:'+hostname,
-		'User-Agent:Python'
-	]
-
-	c = pycurl.Curl()
-	c.fp = None
-	# these keepalive options are not available on CentOS.
-	# these options are kept here for reference.
-	#c.setopt(c.TCP_KEEPALIVE, True)
-	#c.setopt(c.TCP_KEEPINTVL, 30L)
-	#c.setopt(c.TCP_KEEPIDLE, 120L)
-	c.setopt(c.FOLLOWLOCATION, False)
-	c.setopt(c.CONNECTTIMEOUT, 10)
-	# The connection is dropped if the asset isn't downloaded within the c.TIMEOUT window.
-	#c.setopt(c.TIMEOUT, 60L)  # DO NOT set this timeout! 
-	c.setopt(c.NOSIGNAL, True)
-	#c.setopt(c.FORBID_REUSE, True)  # Disabled, it will reuse same TCP socket
-	c.setopt(c.FAILONERROR, True)
-	c.setopt(c.HTTPHEADER, headers)
-	c.setopt(c.NOPROGRESS, False)
-	if debug == True:
-		c.setopt(c.VERBOSE, True)
-	c.setopt(c.URL, url)
-	filename = url.split('/')[-1]
-	local_filename = os.path.join(storage_path, filename)
-	with open(local_filename, 'wb') as f:
-		log.info("Downloading: ["+str(ingest_count)+"/"+str(assets_total)+"] " + filename)
-		c.setopt(c.WRITEFUNCTION, f.write)
-		try:
-			c.perform()
-		except pycurl.error as e:
-			#print('Status Code: %d' % c.getinfo(c.RESPONSE_CODE))
-			if e.args[0] == pycurl.E_COULDNT_CONNECT and c.exception:
-				log.error(c.exception)
-			else:
-				log.error(e)
-			f.close()
-			c.close()	
-			return False
-		log.info('Asset download  ' + filename + ' completed in %0.3f seconds' % c.getinfo(c.TOTAL_TIME))
-	f.close()
-	c.close()
-	return True
+	counts = db_status_counts(database,jobs)
+	return [counts.get(status_new,0), counts.get(status_queued,0), counts.get(status_active,0), counts.get(status_completed,0), counts.get(status_failed,0)]
+
+
+# Download engine callback, the asset transfer finished successfully
+def asset_downloaded(asset, info):
+	global ingest_count
+	ingest_count+=1
+	scheduler.transition(asset[0],status_completed,info['attempts'],info['last_error'],info)
+	if combiner is not None:
+		combiner.complete(combine_index[asset[0]])
+	log.info('Asset download  ['+str(ingest_count)+'/'+str(assets_total)+'] ' + asset[1] + ' completed in %0.3f seconds' % info['total_time'])
+
+# Download engine callback, the asset transfer failed for good
+def asset_download_failed(asset, error, attempts):
+	scheduler.transition(asset[0],status_failed,attempts,error)
+	log.error(error)
+	log.error('Failed to download asset [' + str(asset[0]) + '] ' + asset[1] + ' after ' + str(attempts) + ' attempts')
+	csvfn_errors = log_file.rsplit('.',1)[0] + '_failed.csv'
+	csvfile_errors = os.path.join(log_path, csvfn_errors)
+	csv_asset_failed(asset[1],csvfile_errors,"Failed to download asset from CDN")
 
 def print_assets(assets):
 	for asset in assets:
-		print("[" + str(asset[0]) + "] " + asset[1] + " | " + asset[2] + " | " + str(asset[3]))
+		line = "[" + str(asset[0]) + "] " + asset[1] + " | " + asset[2] + " | " + str(asset[3])
+		if len(asset) > 5 and asset[5]:
+			line += " | " + str(asset[4]) + " attempts, last error: " + asset[5]
+		print(line)
+
+def print_jobs(database):
+	for job_id, name, created, count in db_list_jobs(database):
+		print('[' + str(job_id) + '] ' + name + ' | created ' + created + ' | ' + str(count) + ' assets')
+
+# Averages per CDN edge from db_edge_metrics(), times in milliseconds
+def print_edges(edges):
+	def ms(value):
+		if value is None:
+			return '-'
+		return str(int(value * 1000)) + 'ms'
+	for edge in edges:
+		line = str(edge[0]) + " | " + str(edge[1]) + " transfers | dns " + ms(edge[2]) + " | connect " + ms(edge[3]) + " | first byte " + ms(edge[4]) + " | total " + ms(edge[5])
+		if edge[6] is not None:
+			line += " | " + rate_msg(edge[6])
+		print(line + " | " + str(edge[7]) + " bytes")
 
 def print_help():
 	print()
 	print("Usage:")
 	print("./stream.py -i <input-file>, where -i means 'import'. Imports the m3u8 playlist file into the tool database.")
-	print("./stream.py -p, where -p means 'purge'. Purges all assets from the assets database.")
+	print("./stream.py -p, where -p means 'purge'. Purges all assets from the assets database, or only the assets of the job given with -j.")
 	print("./stream.py -d, where -d means 'delete'. Deletes Completed and Failed assets from the tool database.")
 	print("./stream.py -l, where -l means 'list'. Prints all assets in the tool database.")
 	print("./stream.py -s <output-file>, where -s means 'stream'. Combines all video files into single transport stream.")
+	print("./stream.py -v <port>, where -v means 'virtual'. Serves all video files as a single transport stream at http://127.0.0.1:<port>/stream.ts, with nothing copied.")
+	print("./stream.py -o <output-file>, where -o means 'output'. Runs the download and combines the video files into single transport stream as they arrive.")
+	print("./stream.py -m, where -m means 'metrics'. Prints the transfer times and speed of the downloads per CDN edge, slowest first.")
+	print("./stream.py -j <name>, where -j means 'job'. Picks the job the other options work on, the default job without it. The download takes several jobs, -j <name1>,<name2>.")
 	print("./stream.py -h, where -h means 'help'. Prints this help information.")
 	print("./stream.py, runs the download script.")
 	print()
@@ -493,13 +352,44 @@ def print_help():
 # CLI Command Options
 #----------------------------------------#
 inputfile = ""
+combine_file = ""
 argv = sys.argv[1:]
 try:
-	opts, args = getopt.getopt(argv,"hpdlfs:o:i:o:",["ifile="])
+	opts, args = getopt.getopt(argv,"hpdlmfs:o:i:o:v:j:",["ifile="])
 except getopt.GetoptError:
 	print_help()
 	sys.exit(2)
 
+# The database is created, or migrated from an older version, before any
+# option reads it
+db_check_exists(database)
+
+# Job Selection
+# Every option works on the job given with -j <name>, the default job
+# without it. A job is created the first time it is named.
+job_names = [default_job]
+job_given = False
+for opt, arg in opts:
+	if opt == '-j':
+		job_names = arg.split(',')
+		job_given = True
+# The download can run several jobs at once (-j name1,name2), every
+# other option takes one
+if len(job_names) > 1 and len([opt for opt, arg in opts if opt != '-j']) > 0:
+	print();print("Options other than the download take one job.");print()
+	sys.exit(2)
+try:
+	jobs = [db_get_job(database,name) for name in job_names]
+except ValueError as e:
+	print();print(e);print()
+	sys.exit(2)
+job = jobs[0]
+# Each job downloads to its own folder under storage_path
+job_storage = {}
+for name, job_id in zip(job_names, jobs):
+	job_storage[job_id] = job_storage_path(storage_path, name)
+storage_path = job_storage[job]
+
 for opt, arg in opts:
 
 	# Help
@@ -509,21 +399,24 @@ for opt, arg in opts:
 
 	# Purge
 	elif opt == '-p':
-		db_purge(database)
+		if job_given:
+			db_purge(database,job)
+		else:
+			db_purge(database)
 		sys.exit()
 
 	# Delete
 	elif opt == '-d':
 		# remove all Completed/Failed assets from database and NAS
-		inventory = db_get_inventory(database)
-		assets_completed = inventory[3]
-		assets_failed = inventory[4]
+		# The rows are read up front, they are deleted on the way
+		assets_completed = db_get_status(database,status_completed,job)
+		assets_failed = db_get_status(database,status_failed,job)
 		if len(assets_completed) > 0:
 			print();print('There are ' + str(len(assets_completed)) + ' completed assets that will be deleted.')
 			for asset in assets_completed:
 				time.sleep(0.2)
-				delete_asset_db(asset[0])
-				filename = os.path.join(storage_path, asset[2].split('/')[-1])
+				delete_asset_db(database,asset[0])
+				filename = os.path.join(storage_path, asset[1])
 				deleted = delete_asset(filename)
 				if deleted == True:
 					print('Asset [' + str(asset[0]) + '] ' + filename + ' deleted.')
@@ -538,8 +431,12 @@ for opt, arg in opts:
 			print();print('There are ' + str(len(assets_failed)) + ' failed assets that will be deleted.')
 			for asset in assets_failed:
 				time.sleep(0.2)
-				delete_asset_db(asset[0])
-				filename = os.path.join(storage_path, asset[2].split('/')[-1])
+				delete_asset_db(database,asset[0])
+				filename = os.path.join(storage_path, asset[1])
+				# The version record of a partial download goes with it
+				validator_discard(filename)
+				if not os.path.exists(filename):
+					filename = part_filename(filename)
 				deleted = delete_asset(filename)	
 				if deleted == True:
 					print('Asset [' + str(asset[0]) + '] ' + filename + ' deleted.')
@@ -551,59 +448,98 @@ for opt, arg in opts:
 
 	# List
 	elif opt == '-l':
+		print();print('Jobs:')
+		print_jobs(database)
+		print();print('Job = ' + job_names[0])
 		inventory = db_get_inventory(database)
-		assets_new = inventory[0]
-		if len(assets_new) > 0:
-			print();print("New Assets = " + str(len(assets_new)))
-			print_assets(assets_new)
-		assets_queued = inventory[1]
-		if len(assets_queued) > 0:
-			print();print("Queued Assets = " + str(len(assets_queued)))
-			print_assets(assets_queued)
-		assets_active = inventory[2]
-		if len(assets_active) > 0:
-			print();print("Active Assets = " + str(len(assets_active)))
-			print_assets(assets_active)
-		assets_completed = inventory[3]
-		if len(assets_completed) > 0:
-			print();print("Completed Assets = " + str(len(assets_completed)))
-			print_assets(assets_completed)
-		assets_failed = inventory[4]
-		if len(assets_failed) > 0:
-			print();print("Failed Assets = " + str(len(assets_failed)))
-			print_assets(assets_failed)
-		if (len(assets_new) == 0) and (len(assets_queued) == 0) and (len(assets_active) == 0) and (len(assets_completed) == 0) and (len(assets_failed) == 0):
+		count_new = inventory[0]
+		if count_new > 0:
+			print();print("New Assets = " + str(count_new))
+			print_assets(db_iter_status(database,status_new,job))
+		count_queued = inventory[1]
+		if count_queued > 0:
+			print();print("Queued Assets = " + str(count_queued))
+			print_assets(db_iter_status(database,status_queued,job))
+		count_active = inventory[2]
+		if count_active > 0:
+			print();print("Active Assets = " + str(count_active))
+			print_assets(db_iter_status(database,status_active,job))
+		count_completed = inventory[3]
+		if count_completed > 0:
+			print();print("Completed Assets = " + str(count_completed))
+			print_assets(db_iter_status(database,status_completed,job))
+		count_failed = inventory[4]
+		if count_failed > 0:
+			print();print("Failed Assets = " + str(count_failed))
+			print_assets(db_iter_status(database,status_failed,job))
+		if (count_new == 0) and (count_queued == 0) and (count_active == 0) and (count_completed == 0) and (count_failed == 0):
 			print();print("The database contains no assets.")
 		get_inventory_print(database)
 		print();sys.exit()
 	
+	# Transfer metrics per CDN edge
+	elif opt == '-m':
+		edges = db_edge_metrics(database,job)
+		if len(edges) > 0:
+			print();print("CDN edges of job " + job_names[0] + ", slowest first:")
+			print_edges(edges)
+		else:
+			print();print("There are no transfer metrics, they are recorded as assets download.")
+		print();sys.exit()
+
 	# Combine video files to a single stream file
 	elif opt == '-s':
 		output_file = arg
 		counter = 1
 		if output_file:
-			inventory = db_get_inventory(database)
-			assets_completed = inventory[3]
-			out_data = b''
-			for asset in assets_completed:
-				with open(storage_path + asset[1], 'rb') as fp:
-					print('[' + str(counter) + '] ' + asset[1])
-					out_data += fp.read()
-				counter += 1	
-			fp.close()
-			print();print("Combining all *.ts files into single stream file " + output_file + "...")
-			with open(output_file, 'wb') as fp:
-				fp.write(out_data)
-			fp.close()
+			# Databases from older versions get the sequence columns first
+			db_check_exists(database)
+			# Segments missing from the middle of the stream would be skipped
+			gaps = db_sequence_gaps(database,status_completed,job)
+			if len(gaps) > 0:
+				print();print("Warning: segments " + gaps_msg(gaps) + " are not downloaded and will be missing from " + output_file + ".")
+			print();print("Combining all *.ts files into single stream file " + output_file + "...");print()
+			# Segments are streamed into the output file in playlist order, nothing is held in memory
+			combiner = Combiner(output_file)
+			for asset in db_iter_status(database,status_completed,job):
+				print('[' + str(counter) + '] ' + asset[1])
+				combiner.append(storage_path + asset[1])
+				counter += 1
+			combiner.close()
+			print();print(combiner.summary())
 			print();print('Done.')
 		else:
 			print();print("Stream filename not specified.")
 		print();sys.exit()
 
+	# Serve video files as a single stream file over local HTTP
+	elif opt == '-v':
+		port = int(arg)
+		db_check_exists(database)
+		gaps = db_sequence_gaps(database,status_completed,job)
+		if len(gaps) > 0:
+			print();print("Warning: segments " + gaps_msg(gaps) + " are not downloaded and will be missing from the stream.")
+		completed = db_get_status(database,status_completed,job)
+		filenames = [storage_path + asset[1] for asset in completed]
+		durations = [asset[11] for asset in completed]
+		if len(filenames) > 0:
+			stream = VirtualStream(filenames)
+			write_playlist('playback.m3u8', filenames, durations)
+			print();print(stream.summary() + ', playlist written to playback.m3u8')
+			print('Serving http://127.0.0.1:' + str(port) + stream_path + ' (Ctrl-C to stop)...')
+			serve_stream(stream, port, debug)
+		else:
+			print();print("There are no completed assets to serve.")
+		print();sys.exit()
+
 	# Import assets list file or HLS playlist
 	elif opt in ("-i", "--ifile"):
 		inputfile = arg
 
+	# Combine video files to a single stream file while downloading
+	elif opt == '-o':
+		combine_file = arg
+
 #----------------------------------------#
 # Run asset importer
 #----------------------------------------#
@@ -655,8 +591,9 @@ log.addHandler(handler)
 # if debug:
 # 	logging.getLogger('urllib3').setLevel(logging.DEBUG)
 
-# Create storage path if it doesn't exist
-make_sure_path_exists(storage_path)
+# Create storage paths if they don't exist
+for path in job_storage.values():
+	make_sure_path_exists(path)
 
 print()
 log.info('--------------------------------')
@@ -667,32 +604,18 @@ log.info('Stream Downloader Tool')
 #----------------------------------------#
 # Initialize Asset Inventory from DB
 #----------------------------------------#
-# [New, Queued, Active, Completed, Not Found, Failed]
-# Ingest Status:
-# 0 New
-# 1 Queued
-# 2 Active
-# 3 Completed
-# 4 Not Found
-# 5 Failed
-status_new = 0
-status_queued = 1
-status_active = 2
-status_completed = 3
-status_failed = 5
 
 #----------------------------------------#
 if db_check_exists(database):
 	inventory = db_get_inventory_log(database)
-	assets_new = inventory[0]
-	assets_queued = inventory[1]
-	assets_active = inventory[2]
-	assets_completed = inventory[3]
-	assets_failed = inventory[4]
-	assets_total = len(assets_new) + len(assets_queued) + len(assets_failed)
+	count_new = inventory[0]
+	count_queued = inventory[1]
+	count_active = inventory[2]
+	count_failed = inventory[4]
+	assets_total = count_new + count_queued + count_failed
 
 # Determine if we need to continue processing assets from the last time the script was run
-if (len(assets_new) > 0) or (len(assets_queued) > 0) or (len(assets_active) > 0) or (len(assets_failed) > 0):
+if (count_new > 0) or (count_queued > 0) or (count_active > 0) or (count_failed > 0):
 	log.info('... Downloading ...')
 	ingesting = True
 else:
@@ -703,126 +626,143 @@ else:
 # Main Download Processing Loop
 #----------------------------------------#
 
-while ingesting:
+# Request rate and bandwidth limits shared by every transfer
+limiter = RateLimiter(host_requests_per_sec, max_bytes_per_sec)
+if limiter.enabled():
+	set_limiter(limiter)
+	log.info(limiter.summary())
 
-	#----------------------------------------#
-	# Exit if no assets available or ingest completed
-	if (len(assets_new) == 0) and (len(assets_queued) == 0) and (len(assets_active) == 0) and (len(assets_failed) == 0):
-		ingesting = False
-		log.info('There are no assets ready to download, or script has completed. Exiting...')
-		db_get_inventory_log(database)
+# Stalled transfers are aborted and retried
+set_stall_limits(stall_min_speed, http_timeout)
 
-	# Download continues ...
-	else:
-		# Wait a bit before downloading next file
-		#time.sleep(ingest_interval)
+# Failed downloads are retried by the download engine, after a backoff
+retry = RetryPolicy(retry_attempts, retry_base_delay, retry_max_delay)
+log.info(retry.summary())
 
-		# Get current asset inventory for processing
-		inventory = db_get_inventory(database)
-		assets_new = inventory[0]
-		assets_queued = inventory[1]
-		assets_active = inventory[2]
-		assets_completed = inventory[3]
-		assets_failed = inventory[4]
-
-		log.debug('----------------')
-		log.debug('Asset Inventory:')
-		for asset in assets_new:
-			log.debug(asset)
-		log.debug('New       = ' + str(len(assets_new)))
-		for asset in assets_queued:
-			log.debug(asset)
-		log.debug('Queued    = ' + str(len(assets_queued)))
-		for asset in assets_active:
-			log.debug(asset)
-		log.debug('Active    = ' + str(len(assets_active)))
-		for asset in assets_completed:
-			log.debug(asset)
-		log.debug('Completed = ' + str(len(assets_completed)))
-		for asset in assets_failed:
-			log.debug(asset)
-		log.debug('Failed    = ' + str(len(assets_failed)))
-
-
-	#----------------------------------------#
-	# Process Queued Assets
-	# Check if the asset is ingested already
-	# Move Queued assets to Active status based on available active spot availability based on queue limit
-	# Upgrade Asset to Active status if createCBRasset call was successful
-	if len(assets_queued) > 0:
-
-		# check if active queue has an empty spot, if yes move queued asset(s) to active
-		if len(assets_active) < queue_limit:
-
-			active_slots = queue_limit - len(assets_active)
-			count = 0
-
-			for asset in assets_queued:
-				if active_slots > 0:
-					downloaded = False
-
-					# slack off a bit before each asset download
-					#time.sleep(0.05)
-
-					# Download the asset file if not downloaded already
-					# Allows resume from last downloaded file
-					if not file_check_exists(os.path.join('video/', asset[1])):
-						downloaded = download_target(asset[2],ingest_count+1,assets_total)
-					else:
-						continue
-
-					# Update database only if download was successful.
-					if downloaded == True:
-						db_update_asset_status(database,asset[0],status_completed)
-						log.debug('Asset [' + str(asset[0]) + '] ' + asset[1] + ' was successfully downloaded.')
-						count+=1
-						active_slots-=1	
-						ingest_count+=1
-					else:
-						db_update_asset_status(database,asset[0],status_failed)
-						log.error('Failed to download asset [' + str(asset[0]) + '] ' + asset[1])
-						csvfn_errors = log_file.rsplit('.',1)[0] + '_failed.csv'
-						csvfile_errors = os.path.join(log_path, csvfn_errors)
-						if os.path.exists(csvfile_errors) == False:
-							with open(csvfile_errors, 'w') as f:
-								f.write('asset,error\n')
-							f.close()
-						csv_asset_failed(asset[1],csvfile_errors,"Failed to download asset from CDN")
-
-
-	#--------------------------------------	--#
-	# Process New Assets
-	# Move New assets to Queued status
-	if len(assets_new) > 0:
-		log.info('There are ' + str(len(assets_new)) + ' new assets to download.' )
-		count = 0
-		for asset in assets_new:
-			db_update_asset_status(database,asset[0],status_queued)
-			log.debug('Moved New asset [' + str(asset[0]) + '] ' + asset[1] + ' to Queue status.')
-			count+=1
-		log.info('There are ' + str(count) + ' new assets moved to download queue.')
-
-	#----------------------------------------#
-	# Process Failed Assets
-	# Move Failed assets to Queued status
-	if len(assets_failed) > 0:
-		log.info('There are ' + str(len(assets_failed)) + ' failed assets to re-download.' )
-		count = 0
-		for asset in assets_failed:
-			db_update_asset_status(database,asset[0],status_queued)
+# Transfers stuck before their first byte are sent again, within the budget
+hedge = None
+if hedge_budget > 0:
+	hedge = HedgeTracker(hedge_budget)
+
+#----------------------------------------#
+# Scheduler
+# Queued assets are claimed in batches and kept in memory, state changes are
+# written to the database in batches. The download transport keeps the
+# leases of the claimed assets while it runs.
+scheduler = Scheduler(database, jobs, status_queued, status_active, lease_time)
+
+# queue_limit is the starting level when the concurrency adapts to the network.
+# The process transport starts a fixed pool of queue_limit workers and has no
+# controller.
+if adaptive_concurrency and transport != 'process':
+	controller = AimdController(queue_limit, maximum=concurrency_max)
+	downloader = get_transport(transport, concurrency_max, debug, controller, retry, hedge, scheduler)
+else:
+	controller = None
+	downloader = get_transport(transport, queue_limit, debug, retry=retry, hedge=hedge, keeper=scheduler)
+log.info('Download transport = ' + downloader.name)
+
+#----------------------------------------#
+# Combine While Downloading
+# Every segment is appended to the output file as soon as it and all the
+# segments before it are on disk, so the stream file is ready shortly after
+# the last download finishes
+combiner = None
+combine_index = {}
+if combine_file:
+	filenames = []
+	completed = []
+	for asset in db_get_assets(database,job):
+		filename = os.path.join(storage_path, asset[1])
+		combine_index[asset[0]] = len(filenames)
+		if asset[3] == status_completed and file_check_exists(filename):
+			completed.append(len(filenames))
+		filenames.append(filename)
+	log.info('Combining ' + str(len(filenames)) + ' segments into ' + combine_file + ' while downloading')
+	combiner = OrderedCombiner(combine_file, filenames)
+	for index in completed:
+		combiner.complete(index)
+
+#----------------------------------------#
+# Process Failed Assets
+# Assets that failed in an earlier run get another round of attempts, assets
+# that fail in this run stay failed until the script is run again
+if count_failed > 0:
+	for job_id in jobs:
+		for asset in db_iter_status(database,status_failed,job_id):
 			log.info('Moved failed asset [' + str(asset[0]) + '] ' + asset[1] + ' to download queue.')
-			filename = os.path.join(storage_path, asset[1])
-			deleted = delete_asset(filename)
-			if deleted == True:
-				log.info('Asset [' + str(asset[0]) + '] ' + filename + ' deleted.')
-			elif deleted == False:
-				log.error('Asset [' + str(asset[0]) + '] ' + filename + ' not deleted.')
-		log.info('There are ' + str(len(assets_failed)) + ' failed assets moved to download queue.')		
+			# Keep the partial file, the download continues from its last byte
+			filename = os.path.join(job_storage[job_id], asset[1])
+			offset = resume_offset(filename)
+			if offset > 0:
+				log.info('Asset [' + str(asset[0]) + '] ' + filename + ' will resume from byte ' + str(offset) + '.')
+	count = scheduler.move([status_failed],status_queued)
+	log.info('There are ' + str(count) + ' failed assets moved to download queue.')
 
+#----------------------------------------#
+# Process New Assets
+# Move New assets to Queued status
+if count_new > 0:
+	log.info('There are ' + str(count_new) + ' new assets to download.' )
+	count = scheduler.move([status_new],status_queued)
+	log.info('There are ' + str(count) + ' new assets moved to download queue.')
+
+#----------------------------------------#
+# Process Queued Assets
+# Check if the asset is ingested already
+# Hand each claimed batch to the download engine, it keeps up to queue_limit
+# transfers in flight and completes/fails each asset as it finishes
+if ingesting:
+	# Other stream.py processes may be working on the same job, every asset
+	# goes to the process that claims it
+	while True:
+		claimed = scheduler.claim(claim_size)
+		if len(claimed) == 0:
+			break
+		log.info('Claimed ' + str(len(claimed)) + ' assets.')
+		downloads = []
+		for asset in claimed:
+			# Download the asset file if not downloaded already
+			# Allows resume from last downloaded file
+			# Each asset goes to the folder of its job
+			path = job_storage[asset[8]]
+			if file_check_exists(os.path.join(path, asset[1])):
+				scheduler.transition(asset[0],status_completed)
+				log.debug('Asset [' + str(asset[0]) + '] ' + asset[1] + ' already downloaded.')
+				if combiner is not None:
+					combiner.complete(combine_index[asset[0]])
+				continue
+			local_filename = os.path.join(path, asset[1])
+			downloads.append((asset, asset[2], local_filename))
+
+		if len(downloads) > 0:
+			log.info('Downloading ' + str(len(downloads)) + ' assets, ' + str(downloader.slots()) + ' at a time.')
+			downloader.run(downloads, asset_downloaded, asset_download_failed)
+
+	scheduler.close()
+	log.info('There are no assets ready to download, or script has completed. Exiting...')
+	db_get_inventory_log(database)
+
+downloader.close()
 
 #----------------------------------------#
 # Exit Summary
 log.info('Assets Downloaded = ' + str(ingest_count))
+log.info(reuse_summary(downloader.summary()))
+log.info(retry_summary(*downloader.retry_stats()))
+log.info(stall_summary(downloader.stalls))
+log.info(scheduler.summary())
+if combiner is not None:
+	combiner.close()
+	log.info(combiner.summary())
+	if not combiner.finished():
+		log.warning('Stream file ' + combine_file + ' stops before ' + combiner.missing() + ', which is not downloaded')
+if hedge is not None and downloader.name != 'process':
+	log.info(hedge.summary())
+if controller is not None:
+	log.info(controller.summary())
+close_pool()
+close_db()
 log.info('--------------------------------')
 log.info('Completed')
 
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: Extent cloning of the Combiner (combine.py). The test filesystem
+#  may not clone, so FICLONERANGE is played by a stand-in that applies the
+#  kernel's alignment rules and copies the range, and records what it did.
+#  python3 -m unittest discover tests
+# -----------------------------------------------------------------------------
+#
+### Packages
+import os
+import sys
+import errno
+import shutil
+import struct
+import tempfile
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Stream Combine
+import combine
+from combine import Combiner, ts_packet_size, ts_null_packet
+
+block_size = 4096
+
+#-----------------------------------------------------------------------#
+# Clone Stand-in
+#-----------------------------------------------------------------------#
+
+# fcntl with an ioctl() that clones like XFS/btrfs: the offsets must be block
+# aligned and so must the length, unless the range runs to the end of the
+# source. With 'strict' an unaligned length is never accepted, with
+# 'unsupported' the filesystem can't clone at all.
+class CloneFcntl:
+
+	def __init__(self, strict=False, unsupported=False):
+		self.strict = strict
+		self.unsupported = unsupported
+		# (source offset, length, output offset) of every clone
+		self.clones = []
+
+	def ioctl(self, dst_fd, request, arg):
+		if self.unsupported:
+			raise OSError(errno.EOPNOTSUPP, 'Operation not supported')
+		src_fd, src_offset, length, dst_offset = struct.unpack('qQQQ', arg)
+		to_end = src_offset + length == os.fstat(src_fd).st_size
+		if src_offset % block_size or dst_offset % block_size:
+			raise OSError(errno.EINVAL, 'Invalid argument')
+		if length % block_size and (self.strict or not to_end):
+			raise OSError(errno.EINVAL, 'Invalid argument')
+		os.pwrite(dst_fd, os.pread(src_fd, length, src_offset), dst_offset)
+		self.clones.append((src_offset, length, dst_offset))
+		return 0
+
+# A TS segment of 'packets' packets, each filled with its segment number
+def ts_segment(number, packets):
+	return (b'\x47\x01\x00\x10' + bytes([number]) * 184) * packets
+
+#-----------------------------------------------------------------------#
+# Tests
+#-----------------------------------------------------------------------#
+
+class CombineCloneTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.output_file = os.path.join(self.folder, 'output.ts')
+		self.saved_fcntl = combine.fcntl
+
+	def tearDown(self):
+		combine.fcntl = self.saved_fcntl
+		shutil.rmtree(self.folder)
+
+	def combine(self, fake, segments):
+		combine.fcntl = fake
+		combiner = Combiner(self.output_file)
+		combiner.block_size = block_size
+		combiner.clone = True
+		for index, data in enumerate(segments):
+			filename = os.path.join(self.folder, 'seg' + str(index) + '.ts')
+			with open(filename, 'wb') as f:
+				f.write(data)
+			combiner.append(filename)
+		combiner.close()
+		with open(self.output_file, 'rb') as f:
+			output = f.read()
+		return combiner, output
+
+	# Every TS segment starts on a block boundary and is cloned whole, the
+	# gaps hold null packets only
+	def test_ts_segments_cloned_whole(self):
+		fake = CloneFcntl()
+		segments = [ts_segment(1, 30), ts_segment(2, 47), ts_segment(3, 12)]
+		combiner, output = self.combine(fake, segments)
+		self.assertEqual(combiner.copied, 0)
+		self.assertEqual(combiner.cloned, sum([len(data) for data in segments]))
+		self.assertEqual([clone[2] % block_size for clone in fake.clones], [0, 0, 0])
+		self.assertEqual([clone[1] for clone in fake.clones], [len(data) for data in segments])
+		packets = [output[i:i + ts_packet_size] for i in range(0, len(output), ts_packet_size)]
+		self.assertEqual(b''.join([p for p in packets if p != ts_null_packet]), b''.join(segments))
+		self.assertEqual(combiner.padded, len(output) - len(b''.join(segments)))
+
+	# A filesystem that only clones whole blocks: the aligned part of each
+	# segment is cloned, the tail copied, and the next TS segment is aligned again
+	def test_aligned_prefix_then_copy(self):
+		fake = CloneFcntl(strict=True)
+		segments = [ts_segment(1, 30), ts_segment(2, 47)]
+		combiner, output = self.combine(fake, segments)
+		self.assertEqual([clone[1] for clone in fake.clones], [4096, 8192])
+		self.assertEqual(combiner.cloned, 4096 + 8192)
+		self.assertEqual(combiner.copied, len(segments[0]) - 4096 + len(segments[1]) - 8192)
+		packets = [output[i:i + ts_packet_size] for i in range(0, len(output), ts_packet_size)]
+		self.assertEqual(b''.join([p for p in packets if p != ts_null_packet]), b''.join(segments))
+
+	# Files that are not TS are never padded: once the output is off a
+	# block boundary the rest is copied
+	def test_other_files_copied_after_first_unaligned_end(self):
+		fake = CloneFcntl()
+		segments = [b'a' * 8192, b'b' * 5000, b'c' * 6000]
+		combiner, output = self.combine(fake, segments)
+		self.assertEqual(output, b''.join(segments))
+		self.assertEqual([clone[1] for clone in fake.clones], [8192, 5000])
+		self.assertEqual(combiner.copied, 6000)
+		self.assertEqual(combiner.padded, 0)
+
+	# Without clone support the output is the plain concatenation
+	def test_unsupported_filesystem(self):
+		fake = CloneFcntl(unsupported=True)
+		segments = [ts_segment(1, 30), ts_segment(2, 47)]
+		combiner, output = self.combine(fake, segments)
+		self.assertEqual(output, b''.join(segments))
+		self.assertEqual(combiner.cloned, 0)
+		self.assertEqual(combiner.padded, 0)
+		self.assertFalse(combiner.clone)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: Upgrading databases that hold assets imported more than once
+#  (db.py). The unique (job, asset_uri) index can only be created once the
+#  duplicates are gone, and the copy kept must be the one that got furthest.
+#  python3 -m unittest discover tests
+# -----------------------------------------------------------------------------
+#
+### Packages
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Database
+from db import db_upgrade, close_db, sql_assets, sql_metrics, status_new, status_queued, status_completed, status_failed
+
+# The assets table of the first stream.py
+sql_assets_baseline = """ CREATE TABLE "assets" (
+	id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	asset TEXT NOT NULL DEFAULT "",
+	asset_uri TEXT NOT NULL DEFAULT "",
+	status INTEGER NOT NULL DEFAULT 0
+); """
+
+#-----------------------------------------------------------------------#
+# Tests
+#-----------------------------------------------------------------------#
+
+class UpgradeDuplicatesTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.database = os.path.join(self.folder, 'database.db')
+
+	def tearDown(self):
+		close_db()
+		shutil.rmtree(self.folder)
+
+	def rows(self):
+		conn = sqlite3.connect(self.database)
+		rows = conn.execute("SELECT id, asset, status, sequence FROM assets ORDER BY id").fetchall()
+		conn.close()
+		return rows
+
+	# A first stream.py database, where rumble.py wrote 7 for completed
+	def test_baseline_keeps_furthest_copy(self):
+		conn = sqlite3.connect(self.database)
+		conn.execute(sql_assets_baseline)
+		conn.executemany("INSERT INTO assets (id, asset, asset_uri, status) VALUES (?,?,?,?)", [
+			(1, 'seg1.ts', 'http://cdn/seg1.ts', status_new),
+			(2, 'seg1.ts', 'http://cdn/seg1.ts', 7),
+			(3, 'seg2.ts', 'http://cdn/seg2.ts', status_failed),
+			(4, 'seg2.ts', 'http://cdn/seg2.ts', status_queued),
+			(5, 'seg3.ts', 'http://cdn/seg3.ts', status_new),
+			(6, 'seg3.ts', 'http://cdn/seg3.ts', status_new),
+			(7, 'seg4.ts', 'http://cdn/seg4.ts', status_completed)])
+		conn.commit()
+		conn.close()
+		db_upgrade(self.database)
+		self.assertEqual(self.rows(), [
+			(2, 'seg1.ts', status_completed, 2),
+			(4, 'seg2.ts', status_queued, 4),
+			(5, 'seg3.ts', status_new, 5),
+			(7, 'seg4.ts', status_completed, 7)])
+
+	# A database with jobs and metrics but no unique index yet: the
+	# completed copy keeps its metrics, the same asset in another job stays
+	def test_completed_copy_keeps_metrics(self):
+		conn = sqlite3.connect(self.database)
+		conn.execute("CREATE TABLE jobs (id INTEGER NOT NULL PRIMARY KEY, name TEXT NOT NULL UNIQUE, created TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)")
+		conn.execute("INSERT INTO jobs (id, name) VALUES (0, 'default'), (1, 'concert')")
+		conn.execute(sql_assets)
+		conn.execute(sql_metrics)
+		conn.executemany("INSERT INTO assets (id, asset, asset_uri, status, sequence, job) VALUES (?,?,?,?,?,?)", [
+			(1, 'seg1.ts', 'http://cdn/seg1.ts', status_failed, 1, 0),
+			(2, 'seg1.ts', 'http://cdn/seg1.ts', status_completed, 2, 0),
+			(3, 'seg1.ts', 'http://cdn/seg1.ts', status_new, 1, 1)])
+		conn.execute("INSERT INTO metrics (asset_id, recorded, size) VALUES (2, 0, 1000)")
+		conn.execute("PRAGMA user_version=3")
+		conn.commit()
+		conn.close()
+		db_upgrade(self.database)
+		self.assertEqual(self.rows(), [
+			(2, 'seg1.ts', status_completed, 2),
+			(3, 'seg1.ts', status_new, 1)])
+		conn = sqlite3.connect(self.database)
+		self.assertEqual(conn.execute("SELECT asset_id, size FROM metrics").fetchall(), [(2, 1000)])
+		conn.close()
+
+if __name__ == '__main__':
+	unittest.main()
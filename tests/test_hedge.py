@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: Hedged transfers of the CurlMulti engine (downloader.py) where the
+#  original request and its hedge finish in the same info_read() batch.
+#  A local HTTP server holds the first request until the hedge arrives,
+#  then answers both at the same moment, and the engine reads both replies
+#  in one perform().
+#  python3 -m unittest discover tests
+# -----------------------------------------------------------------------------
+#
+### Packages
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import http.server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Download Engine
+from downloader import MultiDownloader
+from curl_pool import CurlPool
+from hedge import HedgeTracker
+
+body = b'0123456789' * 1000
+
+#-----------------------------------------------------------------------#
+# Test Server
+#-----------------------------------------------------------------------#
+
+# Both requests of an asset wait for each other and are answered together.
+# 'statuses' are the replies in order of arrival, 200 sends the body.
+class PairHandler(http.server.BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		server = self.server
+		with server.lock:
+			status = server.statuses[server.arrived]
+			server.arrived += 1
+			if server.arrived == len(server.statuses):
+				server.all_arrived.set()
+		try:
+			server.barrier.wait(timeout=10)
+		except threading.BrokenBarrierError:
+			pass
+		# Let the engine get back to select() before anything is sent
+		time.sleep(0.05)
+		if status == 200:
+			self.send_response(200)
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+		else:
+			self.send_response(status)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+		self.wfile.flush()
+		with server.lock:
+			server.replied += 1
+			if server.replied == len(server.statuses):
+				server.all_replied.set()
+
+def start_server(statuses):
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), PairHandler)
+	server.daemon_threads = True
+	server.statuses = statuses
+	server.arrived = 0
+	server.replied = 0
+	server.all_arrived = threading.Event()
+	server.all_replied = threading.Event()
+	server.lock = threading.Lock()
+	server.barrier = threading.Barrier(len(statuses))
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+# The engine's CurlMulti, except that select() doesn't wake up for the
+# replies: once both requests reached the server it waits for both replies
+# to be sent. The next perform() reads them together and info_read()
+# reports both transfers in one batch.
+class HeldMulti:
+
+	def __init__(self, multi, server):
+		self.multi = multi
+		self.server = server
+
+	def __getattr__(self, name):
+		return getattr(self.multi, name)
+
+	def select(self, timeout):
+		if not self.server.all_arrived.wait(timeout):
+			return 0
+		self.server.all_replied.wait(10)
+		time.sleep(0.05)
+		return 1
+
+#-----------------------------------------------------------------------#
+# Tests
+#-----------------------------------------------------------------------#
+
+class HedgeSameBatchTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.completed = []
+		self.failed = []
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	# Run one asset with a hedge sent almost at once, the replies to the
+	# request and to the hedge are released together
+	def run_pair(self, statuses):
+		server = start_server(statuses)
+		self.addCleanup(server.server_close)
+		self.addCleanup(server.shutdown)
+		hedge = HedgeTracker(budget=1.0, min_samples=1, min_delay=0.05)
+		hedge.record(0.01)
+		pool = CurlPool()
+		downloader = MultiDownloader(2, pool=pool, hedge=hedge)
+		downloader.multi = HeldMulti(downloader.multi, server)
+		local_filename = os.path.join(self.folder, 'seg1.ts')
+		url = 'http://127.0.0.1:' + str(server.server_address[1]) + '/seg1.ts'
+		done = downloader.run([('seg1', url, local_filename)], lambda asset, info: self.completed.append(asset), lambda asset, error, attempts: self.failed.append(asset))
+		downloader.close()
+		pool.close()
+		self.assertEqual(server.arrived, 2)
+		self.assertEqual(done, 1)
+		return local_filename
+
+	def test_both_copies_complete(self):
+		local_filename = self.run_pair([200, 200])
+		self.assertEqual(self.completed, ['seg1'])
+		self.assertEqual(self.failed, [])
+		with open(local_filename, 'rb') as f:
+			self.assertEqual(f.read(), body)
+		self.assertEqual(sorted(os.listdir(self.folder)), ['seg1.ts'])
+
+	def test_winner_completes_loser_fails(self):
+		local_filename = self.run_pair([200, 503])
+		self.assertEqual(self.completed, ['seg1'])
+		self.assertEqual(self.failed, [])
+		with open(local_filename, 'rb') as f:
+			self.assertEqual(f.read(), body)
+		self.assertEqual(sorted(os.listdir(self.folder)), ['seg1.ts'])
+
+if __name__ == '__main__':
+	unittest.main()
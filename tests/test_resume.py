@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: Resuming partial files only while the asset on the server is the
+#  one they hold the start of (downloader.py, aio_downloader.py). A local
+#  HTTP server serves byte ranges with an ETag and honours If-Range; the
+#  partial files left in place are stale, unknown or good.
+#  python3 -m unittest discover tests
+# -----------------------------------------------------------------------------
+#
+### Packages
+import os
+import re
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import http.server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Download Engines
+from downloader import download_file, download_segmented, part_filename, validator_filename, ranges_filename
+from aio_downloader import AsyncDownloader
+from curl_pool import CurlPool
+
+body = bytes(range(256)) * 40
+etag = '"v2"'
+
+#-----------------------------------------------------------------------#
+# Test Server
+#-----------------------------------------------------------------------#
+
+# Serves 'body' under any path. A Range request gets a 206 unless its
+# If-Range names another version, then the whole body comes back as a 200.
+# With server.wrong_start the 206 replies start at byte 0 whatever was asked.
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		server = self.server
+		requested = self.headers.get('Range')
+		if_range = self.headers.get('If-Range')
+		server.requests.append((requested, if_range))
+		m = re.match(r'bytes=(\d+)-(\d*)', requested or '')
+		if m is None or (if_range is not None and if_range != etag):
+			self.send_response(200)
+			self.send_header('ETag', etag)
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+			return
+		start = int(m.group(1))
+		end = int(m.group(2) or len(body) - 1)
+		if server.wrong_start:
+			start = 0
+		self.send_response(206)
+		self.send_header('ETag', etag)
+		self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(end) + '/' + str(len(body)))
+		self.send_header('Content-Length', str(end - start + 1))
+		self.end_headers()
+		self.wfile.write(body[start:end + 1])
+
+def start_server(wrong_start=False):
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+	server.daemon_threads = True
+	server.requests = []
+	server.wrong_start = wrong_start
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+#-----------------------------------------------------------------------#
+# Tests
+#-----------------------------------------------------------------------#
+
+class ResumeTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.local_filename = os.path.join(self.folder, 'seg1.ts')
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def serve(self, wrong_start=False):
+		server = start_server(wrong_start)
+		self.addCleanup(server.server_close)
+		self.addCleanup(server.shutdown)
+		self.url = 'http://127.0.0.1:' + str(server.server_address[1]) + '/seg1.ts'
+		return server
+
+	# Leave a partial file and, unless None, the version it was started from
+	def leave_partial(self, data, validator):
+		with open(part_filename(self.local_filename), 'wb') as f:
+			f.write(data)
+		if validator is not None:
+			with open(validator_filename(self.local_filename), 'w') as f:
+				f.write(validator + '\n')
+
+	def download_curl(self):
+		pool = CurlPool()
+		c = pool.get(self.url)
+		try:
+			download_file(c, self.local_filename)
+		finally:
+			pool.put(c)
+			pool.close()
+
+	def download_asyncio(self):
+		downloader = AsyncDownloader(1)
+		failed = []
+		downloader.run([('seg1', self.url, self.local_filename)], lambda asset, info: None, lambda asset, error, attempts: failed.append(error))
+		self.assertEqual(failed, [])
+
+	# The asset is whole under its real name and nothing else is left
+	def assert_whole(self):
+		with open(self.local_filename, 'rb') as f:
+			self.assertEqual(f.read(), body)
+		self.assertEqual(sorted(os.listdir(self.folder)), ['seg1.ts'])
+
+	def check_stale_version(self, download):
+		server = self.serve()
+		self.leave_partial(b'x' * 3000, '"v1"')
+		download()
+		self.assert_whole()
+		# curl starts over on a request of its own, asyncio keeps the 200 reply
+		self.assertEqual(server.requests[0], ('bytes=3000-', '"v1"'))
+		self.assertIn(len(server.requests), (1, 2))
+
+	def check_unknown_partial(self, download):
+		server = self.serve()
+		self.leave_partial(b'x' * 3000, None)
+		download()
+		self.assert_whole()
+		self.assertEqual(server.requests, [(None, None)])
+
+	def check_same_version(self, download):
+		server = self.serve()
+		self.leave_partial(body[:3000], etag)
+		download()
+		self.assert_whole()
+		self.assertEqual(server.requests, [('bytes=3000-', etag)])
+
+	def check_wrong_range(self, download):
+		server = self.serve(wrong_start=True)
+		self.leave_partial(body[:3000], etag)
+		download()
+		self.assert_whole()
+		self.assertEqual(server.requests, [('bytes=3000-', etag), (None, None)])
+
+	def test_curl_stale_version(self):
+		self.check_stale_version(self.download_curl)
+
+	def test_curl_unknown_partial(self):
+		self.check_unknown_partial(self.download_curl)
+
+	def test_curl_same_version(self):
+		self.check_same_version(self.download_curl)
+
+	def test_curl_wrong_range(self):
+		self.check_wrong_range(self.download_curl)
+
+	def test_asyncio_stale_version(self):
+		self.check_stale_version(self.download_asyncio)
+
+	def test_asyncio_unknown_partial(self):
+		self.check_unknown_partial(self.download_asyncio)
+
+	def test_asyncio_same_version(self):
+		self.check_same_version(self.download_asyncio)
+
+	def test_asyncio_wrong_range(self):
+		self.check_wrong_range(self.download_asyncio)
+
+	# A segmented download of another version starts all ranges over
+	def test_segmented_stale_version(self):
+		server = self.serve()
+		half = len(body) // 2
+		self.leave_partial(b'x' * len(body), None)
+		with open(ranges_filename(self.local_filename), 'w') as f:
+			f.write(str(len(body)) + ' "v1"\n0 ' + str(half - 1) + ' ' + str(half) + '\n' + str(half) + ' ' + str(len(body) - 1) + ' 0\n')
+		pool = CurlPool()
+		try:
+			download_segmented(self.url, self.local_filename, 2, 1, pool)
+		finally:
+			pool.close()
+		self.assert_whole()
+		self.assertIn(('bytes=0-' + str(half - 1), etag), server.requests)
+
+if __name__ == '__main__':
+	unittest.main()
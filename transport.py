@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: Pluggable download transports. The download step of stream.py
+#  talks to a Transport and doesn't care how the bytes are fetched.
+#
+#  curl     pycurl.CurlMulti, all transfers in one process (default)
+#  asyncio  one asyncio event loop in one thread, HTTP/1.1 over plain sockets
+#  process  a multiprocessing pool, one blocking pycurl transfer per worker
+#
+#  Select one with 'transport' in the [tool] section of etc/config.conf.
+# -----------------------------------------------------------------------------
+#
+### Packages
+import time
+# Logging
+import logging
+
+log = logging.getLogger('Tool')
+
+#-----------------------------------------------------------------------#
+# Transport Interface
+#-----------------------------------------------------------------------#
+
+# run() downloads a list of jobs, each a tuple (asset, url, local_filename)
+# where 'asset' is whatever the caller uses to identify the asset (usually
+# the database row). At most 'concurrency' transfers are in flight at once.
+# As each transfer finishes the transport calls
+#   on_complete(asset, info)             info is a dict, see transfer_info()
+#   on_failed(asset, error, attempts)    error is a message string
+# Partial files are written and resumed the way downloader.py does it.
+# With an adaptive concurrency controller (concurrency.py) the number of
+# transfers in flight follows the controller, 'concurrency' is the ceiling.
+# With a retry policy (retry.py) a failed transfer is tried again after a
+# backoff and on_failed() is only called once the asset has failed for good.
+# A transfer waiting to be retried keeps its slot, so a struggling host
+# gets fewer requests rather than a burst of retries.
+# With a hedge tracker (hedge.py) a transfer stuck before its first byte is
+# duplicated on another connection and the first copy to finish is kept.
+# With a lease keeper (the Scheduler of scheduler.py) the transport calls
+# keeper.keep() at least once a second while it runs, whether transfers finish
+# or not, so the keeper can renew its leases. keep() returns the assets
+# whose lease was lost to another process: their transfers are stopped,
+# the partial files are kept for the new owner, and neither callback is
+# called for them. A process that was held up past keeper.deadline() (a
+# time.monotonic() time) writes no more data until keep() found out which
+# leases it still holds, the new owner may already be writing the files.
+class Transport:
+
+	name = ''
+
+	def __init__(self, concurrency, debug=False, controller=None, retry=None, hedge=None, keeper=None):
+		self.concurrency = max(1, int(concurrency))
+		self.debug = debug
+		self.controller = controller
+		self.retry = retry
+		self.hedge = hedge
+		self.keeper = keeper
+		# Failed attempts and last error per job, by local filename
+		self.attempts = {}
+		self.last_error = {}
+		self.retries = 0
+		self.failed = 0
+		# Transfers aborted by the stall detection
+		self.stalls = 0
+		# Transfers stopped because their lease was lost
+		self.lost = 0
+
+	# Number of transfers allowed in flight right now
+	def slots(self):
+		if self.controller is not None:
+			return min(self.controller.limit, self.concurrency)
+		return self.concurrency
+
+	# Report a finished transfer to the concurrency controller, and its time
+	# to first byte to the hedge tracker
+	def observe(self, info=None, http_code=None):
+		if self.hedge is not None and info is not None:
+			self.hedge.record(info['ttfb'])
+		if self.controller is None:
+			return
+		if info is not None:
+			self.controller.record(info['size'], info['ttfb'], info['http_code'])
+		else:
+			self.controller.record(http_code=http_code, failed=True)
+
+	# Assets whose lease was lost since the last call, as a set
+	def lost_assets(self):
+		if self.keeper is None:
+			return set()
+		return set(self.keeper.keep())
+
+	# True while the leases of the keeper surely have not run out
+	def leased(self):
+		return self.keeper is None or time.monotonic() < self.keeper.deadline()
+
+	# Wrap the write function of a transfer so it writes nothing once the
+	# leases may have run out, the transfer fails with a write error
+	def leased_writer(self, write):
+		if self.keeper is None:
+			return write
+		def guarded(data):
+			if not self.leased():
+				return 0
+			return write(data)
+		return guarded
+
+	# Forget a job whose lease was lost, it is reported to neither callback
+	def drop(self, job):
+		self.attempts.pop(job[2], None)
+		self.last_error.pop(job[2], None)
+		self.lost += 1
+		log.info('Lease lost, stopped ' + job[1])
+
+	# Count a failed attempt of a job. Returns the seconds to wait before
+	# trying again, or None when the job has failed for good.
+	def failure(self, job, error, http_code=0, errno=0, permanent=False):
+		key = job[2]
+		attempts = self.attempts.get(key, 0) + 1
+		self.attempts[key] = attempts
+		self.last_error[key] = error
+		if self.retry is None or permanent:
+			return None
+		delay = self.retry.next_delay(attempts, http_code, errno)
+		if delay is not None:
+			self.retries += 1
+			log.info('Retrying ' + job[1] + ' in ' + '%0.1f' % delay + ' seconds (attempt ' + str(attempts + 1) + '): ' + error)
+		return delay
+
+	# Report a finished job to the caller with the number of attempts it took
+	def complete(self, job, info, on_complete):
+		info['attempts'] = self.attempts.pop(job[2], 0) + 1
+		info['last_error'] = self.last_error.pop(job[2], None)
+		on_complete(job[0], info)
+
+	def fail(self, job, error, on_failed):
+		attempts = self.attempts.pop(job[2], 1)
+		self.last_error.pop(job[2], None)
+		self.failed += 1
+		on_failed(job[0], error, attempts)
+
+	def run(self, jobs, on_complete, on_failed):
+		raise NotImplementedError
+
+	# [transfers, connections reused] for the run summary
+	def summary(self):
+		return [0, 0]
+
+	# [retries, assets failed for good] for the run summary
+	def retry_stats(self):
+		return [self.retries, self.failed]
+
+	def close(self):
+		pass
+
+# Transfer details handed to on_complete(). Every transport fills in what it
+# knows, missing values are left as None. Times are seconds from the start
+# of the transfer: DNS lookup done, TCP connected, TLS handshake done, first
+# byte (ttfb) and total; 'speed' is the average in bytes/sec. 'attempts'
+# counts the tries it took and 'last_error' is the error of the last failed
+# one, if any.
+def transfer_info(total_time=None, ttfb=None, size=None, http_code=None, primary_ip=None, namelookup_time=None, connect_time=None, appconnect_time=None, speed=None):
+	if speed is None and size is not None and total_time:
+		speed = size / total_time
+	info = {
+		'namelookup_time': namelookup_time,
+		'connect_time': connect_time,
+		'appconnect_time': appconnect_time,
+		'total_time': total_time,
+		'ttfb': ttfb,
+		'size': size,
+		'speed': speed,
+		'http_code': http_code,
+		'primary_ip': primary_ip,
+		'attempts': 1,
+		'last_error': None,
+	}
+	return info
+
+# Names accepted by the 'transport' config option
+transports = ['curl', 'asyncio', 'process']
+
+# Build the transport selected in the config file
+# The process transport has a fixed number of workers and ignores the
+# concurrency controller and the hedge tracker.
+def get_transport(name, concurrency, debug=False, controller=None, retry=None, hedge=None, keeper=None):
+	if name == 'curl':
+		from downloader import MultiDownloader
+		return MultiDownloader(concurrency, debug, controller=controller, retry=retry, hedge=hedge, keeper=keeper)
+	elif name == 'asyncio':
+		from aio_downloader import AsyncDownloader
+		return AsyncDownloader(concurrency, debug, controller, retry, hedge, keeper)
+	elif name == 'process':
+		from downloader import ProcessDownloader
+		return ProcessDownloader(concurrency, debug, retry, keeper)
+	raise ValueError('Unknown transport ' + repr(name) + ', expected one of ' + ', '.join(transports))
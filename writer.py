@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# Author: Anthony Crawford
+# Python Version: 3
+# Purpose: One database writer process for the download workers of
+#  rumble.py/gpt.py. Workers put their state changes on a queue instead of
+#  opening a connection and committing one row each; the writer commits
+#  them in batches, every batch_size changes or every flush_interval
+#  seconds, whichever comes first. Only one process ever writes, so the
+#  workers never wait on the write lock and never see "database is locked".
+# -----------------------------------------------------------------------------
+#
+### Packages
+import time
+import queue
+import sqlite3
+import multiprocessing
+# Database
+from db import db_apply_transitions, metric_values, close_db
+
+# State changes per transaction
+batch_size = 200
+
+# Seconds a state change waits at most before it is written
+flush_interval = 0.25
+
+# Seconds between tries when another process holds the database
+locked_delay = 0.5
+
+# Queue of the writer, set in each worker process by set_writer()
+events = None
+
+#-----------------------------------------------------------------------#
+# Worker Side
+#-----------------------------------------------------------------------#
+
+def set_writer(writer_queue):
+	global events
+	events = writer_queue
+
+# Send a state change of the asset with id 'aid' to the writer, 'last_error'
+# None keeps the stored error. 'info' are the transfer details of a
+# completed download, they go in the metrics table.
+def post_transition(aid, status, attempts=0, last_error=None, info=None):
+	metrics = None
+	if info is not None:
+		metrics = metric_values(info) + (aid,)
+	events.put(((status, attempts, last_error, aid), metrics))
+
+#-----------------------------------------------------------------------#
+# Writer Process
+#-----------------------------------------------------------------------#
+
+# Runs in the writer process until it reads None from the queue.
+# 'stats' is shared with the parent: [changes written, transactions]
+def writer_loop(database, writer_queue, stats, batch_size, flush_interval):
+	batch = []
+	deadline = None
+	running = True
+	while running:
+		timeout = None
+		if deadline is not None:
+			timeout = max(0, deadline - time.monotonic())
+		try:
+			event = writer_queue.get(timeout=timeout)
+		except queue.Empty:
+			event = False
+		if event is None:
+			running = False
+		elif event:
+			batch.append(event)
+			if deadline is None:
+				deadline = time.monotonic() + flush_interval
+		if batch and (not running or len(batch) >= batch_size or time.monotonic() >= deadline):
+			write_batch(database, batch)
+			stats[0] += len(batch)
+			stats[1] += 1
+			batch = []
+			deadline = None
+	close_db()
+
+# Commit a batch, waiting out other processes that hold the database
+# (the -d/-l options of a second instance, sqlite3 shell, ...)
+def write_batch(database, batch):
+	transitions = [event[0] for event in batch]
+	metrics = [event[1] for event in batch if event[1] is not None]
+	while True:
+		try:
+			db_apply_transitions(database, transitions, metrics)
+			return
+		except sqlite3.OperationalError as e:
+			if 'locked' not in str(e) and 'busy' not in str(e):
+				raise
+			time.sleep(locked_delay)
+
+class DbWriter:
+
+	def __init__(self, database, batch_size=batch_size, flush_interval=flush_interval):
+		self.queue = multiprocessing.Queue()
+		self.stats = multiprocessing.Array('q', 2)
+		self.process = multiprocessing.Process(target=writer_loop, args=(database, self.queue, self.stats, batch_size, flush_interval), daemon=True)
+
+	def start(self):
+		self.process.start()
+
+	# Write what is still queued and stop the writer
+	def close(self):
+		self.queue.put(None)
+		self.process.join()
+
+	def summary(self):
+		return 'State Changes = ' + str(self.stats[0]) + ' written in ' + str(self.stats[1]) + ' transactions'